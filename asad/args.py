@@ -72,6 +72,12 @@ INTERACTIVE_OPTIONS = [
         'help'    : 'Assistant mode'
     }),
 
+    (['-t', '--stream'], {
+        'action'  : 'store_true',
+        'default' : False,
+        'help'    : 'Streaming mode, fit observations one at a time'
+    }),
+
     (['-I', '--script'], {
         'type'    : str,
         'default' : None,
@@ -88,6 +94,9 @@ def positive(n):
     else:
         return n
 
+def positive_int(n):
+    return positive(int(n))
+
 GENERAL_OPTIONS = [
     (['-s', '--step'], {
         'metavar' : 'Step',
@@ -136,11 +145,18 @@ GENERAL_OPTIONS = [
         'help'    : 'Statistical test'
     }),
 
+    (['-j', '--jobs'], {
+        'metavar' : 'Jobs',
+        'type'    : positive_int,
+        'default' : None,
+        'help'    : 'Number of processes used to fit objects'
+    }),
+
     (['-p', '--precision'], {
         'metavar' : 'Precision',
-        'type'    : positive,
-        'default' : 6,
-        'help'    : 'Calculation precision'
+        'choices' : pyasad.Asad.PRECISIONS,
+        'default' : None,
+        'help'    : 'Flux storage precision while fitting, statistics are summed in double'
     })
 ]
 
@@ -173,14 +189,20 @@ def list_files(directory):
 
 def process(args):
     if args.interactive:
-        interactive.Main_Shell().cmdloop()
+        interactive.Main_Shell(jobs=args.jobs,
+                               precision=args.precision).cmdloop()
     elif args.run:
-        interactive.Run_Shell().cmdloop()
+        interactive.Run_Shell(jobs=args.jobs,
+                              precision=args.precision).cmdloop()
+    elif args.stream:
+        interactive.Run_Shell(jobs=args.jobs,
+                              precision=args.precision).stream()
     elif args.gui:
         wizard.init()
     elif args.script:
         for s in args.script:
-            interactive.Main_Shell().execute(s)
+            interactive.Main_Shell(jobs=args.jobs,
+                                   precision=args.precision).execute(s)
 
 #===============================================================================
 
@@ -0,0 +1,147 @@
+import hashlib
+import os, os.path
+import uuid
+
+import numpy as np
+
+#===============================================================================
+
+class TextCache(object):
+    """Binary copies of parsed text spectra, so np.loadtxt runs once per file.
+
+    Entries are .npy files named after the source path, its modification
+    time and size, and the loadtxt arguments; editing or replacing a source
+    misses the cache instead of returning stale data. Hits are memory-mapped
+    read-only, only the rows a run touches are paged in.
+
+    Writing an entry removes the other entries of its source, so the cache
+    holds one copy per source file whatever its edits or read windows. It
+    is off unless enabled, it writes into the data directories otherwise.
+    """
+    DIRECTORY_NAME = '.asad_cache'
+
+    enabled = False
+    # None keeps a DIRECTORY_NAME directory next to every source file
+    directory = None
+
+    @staticmethod
+    def source_key(path):
+        "Entry name prefix shared by every entry of the source file path"
+        path = os.path.abspath(path)
+        return hashlib.sha1(path.encode('utf-8')).hexdigest() + '_'
+
+    @staticmethod
+    def key(path, **kwargs):
+        stat = os.stat(path)
+        ident = '\0'.join([repr(stat.st_mtime), repr(stat.st_size),
+                           repr(sorted(kwargs.items()))])
+        return TextCache.source_key(path) + \
+            hashlib.sha1(ident.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def entry_path(path, **kwargs):
+        directory = TextCache.directory or os.path.join(
+            os.path.dirname(os.path.abspath(path)), TextCache.DIRECTORY_NAME)
+        return os.path.join(directory, TextCache.key(path, **kwargs) + '.npy')
+
+    @staticmethod
+    def store(entry, mat):
+        "Write atomically so a concurrent reader never maps a partial file"
+        directory = os.path.dirname(entry)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another reader may have created it meanwhile
+                if not os.path.isdir(directory):
+                    raise
+        temp = '{}.{}.tmp'.format(entry, uuid.uuid4().hex)
+        try:
+            with open(temp, 'wb') as f:
+                np.save(f, mat)
+            os.rename(temp, entry)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+        TextCache.evict(entry)
+
+    @staticmethod
+    def evict(entry):
+        "Remove the other entries of the source entry belongs to"
+        (directory, name) = os.path.split(entry)
+        prefix = name[:name.index('_') + 1]
+        for other in os.listdir(directory):
+            if other.startswith(prefix) and other.endswith('.npy') \
+               and other != name:
+                try:
+                    os.remove(os.path.join(directory, other))
+                except OSError:
+                    # Removed by another reader, or still mapped on Windows
+                    pass
+
+    @staticmethod
+    def loadtxt(path, transpose=False, wavelength_range=None, **kwargs):
+        """np.loadtxt(path, **kwargs), optionally transposed, through the cache.
+
+        With a wavelength_range only the rows TextCache.window_lines keeps
+        are parsed. Any failure to read or write the cache falls back to
+        parsing the text.
+        """
+        if not TextCache.enabled:
+            return TextCache.parse(path, transpose, wavelength_range, **kwargs)
+
+        try:
+            entry = TextCache.entry_path(path, transpose=transpose,
+                                         wavelength_range=wavelength_range,
+                                         **kwargs)
+        except (IOError, OSError):
+            return TextCache.parse(path, transpose, wavelength_range, **kwargs)
+
+        if os.path.isfile(entry):
+            try:
+                return np.load(entry, mmap_mode='r')
+            except (IOError, OSError, ValueError):
+                pass
+
+        mat = TextCache.parse(path, transpose, wavelength_range, **kwargs)
+        try:
+            TextCache.store(entry, mat)
+        except (IOError, OSError):
+            pass
+        return mat
+
+    @staticmethod
+    def parse(path, transpose=False, wavelength_range=None, **kwargs):
+        if wavelength_range is None:
+            mat = np.loadtxt(path, **kwargs)
+        else:
+            with open(path) as f:
+                mat = np.loadtxt(
+                    TextCache.window_lines(f, *wavelength_range), **kwargs)
+        return np.ascontiguousarray(mat.transpose() if transpose else mat)
+
+    @staticmethod
+    def window_lines(lines, start, end):
+        """Lines of a table sorted by its first column that cover [start, end].
+
+        The last row before start and the first row at or after end are
+        kept too, so searchsorted cuts on the result match the full table.
+        Reading stops there, later lines are never split.
+        """
+        previous = None
+        for line in lines:
+            fields = line.split('#', 1)[0].split(None, 1)
+            if not fields:
+                continue
+            wavelength = float(fields[0])
+            if wavelength < start:
+                previous = line
+                continue
+            if previous is not None:
+                yield previous
+                previous = None
+            yield line
+            if wavelength >= end:
+                break
+
+#===============================================================================
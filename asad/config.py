@@ -28,6 +28,12 @@ class GlobalConfig(object):
         base, value = GlobalConfig.get_base_method(key)
         return self.config.get(base, value)
 
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except ConfigParser.Error:
+            return default
+
     def __setitem__(self, key, val):
         base, value = GlobalConfig.get_base_method(key)
         return self.config.set(base, value, val)
@@ -5,6 +5,8 @@ import contextlib
 import io
 import glob
 import math
+import multiprocessing
+import multiprocessing.pool
 import os, os.path
 import re
 import shlex
@@ -18,6 +20,7 @@ init()
 
 import pyasad
 import plot
+import shared
 from config import GlobalConfig
 
 #===============================================================================
@@ -107,9 +110,18 @@ def list_files(directory, pattern=".*"):
         os.path.join(in_dir, f)
         for f in os.listdir(in_dir)
         if re.match(regex, os.path.basename(f))
+        and os.path.isfile(os.path.join(in_dir, f))
     ]
     return in_files
 
+def fit_object(obj):
+    "Process pool worker: returns (fit, None) or (None, error message)"
+    try:
+        obj.calculate_chosen_model()
+        return (obj.get_fit(), None)
+    except Exception as err:
+        return (None, unicode(err))
+
 def base_command(type):
     def command(self, arg):
         try:
@@ -179,6 +191,13 @@ class Shell(cmd.Cmd, object):
 class Base_Shell(Shell):
     asad_type = pyasad.Base
 
+    def __init__(self, *args, **kwargs):
+        self._read_window = None
+        self._read_jobs = 1
+        self._inplace = False
+        self._lazy = False
+        super(Base_Shell, self).__init__(*args, **kwargs)
+
     def do_help(self, arg):
         print('base [list | read | directory]')
 
@@ -205,7 +224,7 @@ class Base_Shell(Shell):
         "Read from a file"
         try:
             path = os.path.abspath(parse_args(arg, expected=1)[0])
-            base = self.asad_type(path=path)
+            base = self.read_value(path)
             self.values.append(base)
             ok_print("Read OK: {}".format(path))
             ok_print("Wavelength Step: {}".format(base.wavelength_step))
@@ -220,10 +239,7 @@ class Base_Shell(Shell):
             path = os.path.abspath(parse_args(arg, expected=1)[0])
             if not os.path.isdir(path):
                 raise(RuntimeError('Must be a directory'))
-            for f in list_files(path):
-                obj = self.asad_type(path=f)
-                self.values.append(obj)
-                ok_print("Read OK: {}".format(f))
+            self.read_files(list_files(path))
         except Exception as err:
             error_print('Directory read failed')
             error_print(unicode(err))
@@ -241,10 +257,7 @@ class Base_Shell(Shell):
                 files = glob.glob(path)
                 if not files:
                     raise ValueError('Invalid Path')
-                for f in files:
-                    obj = self.asad_type(path = f)
-                    self.values.append(obj)
-                    ok_print("Read OK: {}".format(f))
+                self.read_files(files)
         except Exception as err:
             error_print('File or Directory Read Error')
             error_print(unicode(err))
@@ -271,12 +284,12 @@ class Base_Shell(Shell):
         "Normalize a base"
         wavelength = parse_args(arg, expected=1, type=float)[0]
         for (i, base) in enumerate(self.values):
-            self.values[i] = base.normalize(wavelength)
+            self.values[i] = base.normalize(wavelength, inplace=self.inplace)
             ok_print('Normalized: {}'.format(base.name))
 
     def do_normalize_average(self):     #Normalizing the fluxes using the average as a dividor.
         for (i,base) in enumerate(self.values):
-            self.values[i] = base.normalize_average()
+            self.values[i] = base.normalize_average(inplace=self.inplace)
             ok_print('Normalized: {}'.format(base.name))
 
     def do_name(self, arg):
@@ -328,7 +341,8 @@ class Base_Shell(Shell):
         try:
             (start, end) = parse_tuple(arg, expected=2, type=int)
             for (i, base) in enumerate(self.values):
-                self.values[i] = base.wavelength_set_index(start, end)
+                self.values[i] = base.wavelength_set_index(
+                    start, end, inplace=self.inplace)
                 ok_print('Wavelength index set: ({}, {})'.format(start, end))
         except ValueError as value_error:
             error_print('set_wavelength_index (start, end)')
@@ -338,7 +352,8 @@ class Base_Shell(Shell):
         try:
             start = parse_tuple(arg, expected=1, type=float)[0]
             for (i, base) in enumerate(self.values):
-                self.values[i] = base.wavelength_set_start(start)
+                self.values[i] = base.wavelength_set_start(
+                    start, inplace=self.inplace)
                 ok_print('Wavelength start set to: {}'.format(start))
         except ValueError as value_error:
             error_print('set_wavelength_start wl_start')
@@ -355,7 +370,8 @@ class Base_Shell(Shell):
         try:
             end = parse_tuple(arg, expected=1, type=float)[0]
             for (i, base) in enumerate(self.values):
-                self.values[i] = base.wavelength_set_end(end)
+                self.values[i] = base.wavelength_set_end(
+                    end, inplace=self.inplace)
                 ok_print('Wavelength end set to: {}'.format(end))
         except ValueError as value_error:
             error_print('set_wavelength_end wl_end')
@@ -372,7 +388,8 @@ class Base_Shell(Shell):
         try:
             (start, end) = parse_tuple(arg, expected=2, type=float)
             for (i, base) in enumerate(self.values):
-                self.values[i] = base.wavelength_set_range(start, end)
+                self.values[i] = base.wavelength_set_range(
+                    start, end, inplace=self.inplace)
                 ok_print('Wavelength range set: ({}, {})'.format(start, end))
         except ValueError as value_error:
             error_print('set_wavelength_range (wl_start, wl_end)')
@@ -416,11 +433,13 @@ class Base_Shell(Shell):
             args = parse_args(arg, expected=1)
             interp = float(args[0])
             for (i, base) in enumerate(self.values):
+                name = base.name
                 self.values[i] = base.smoothen(
                     interp,
                     name="smoothed_" + base.name,
-                    step=base.wavelength_step)
-                ok_print('Smoothed: {}'.format(base.name))
+                    step=base.wavelength_step,
+                    inplace=self.inplace)
+                ok_print('Smoothed: {}'.format(name))
         except ValueError as value_error:
             error_print('Interpolation step needed')
             raise value_error
@@ -428,6 +447,120 @@ class Base_Shell(Shell):
             error_print('Interpolation step must be a float')
             raise type_error
 
+    def do_set_read_window(self, arg):
+        "Only read rows covering (start, end), no argument reads everything"
+        if not arg.strip():
+            self.read_window = None
+            ok_print('Read window cleared')
+            return
+        self.read_window = parse_tuple(arg, required=True, type=float, expected=2)
+        ok_print('Read window set to: {}'.format(self.read_window))
+
+    def do_set_cache(self, arg):
+        "Keep binary copies of parsed text files (Y/N), off by default"
+        pyasad.TextCache.enabled = parse_yn(arg, default=True)
+        ok_print('Read cache set to: {}'.format(pyasad.TextCache.enabled))
+
+    def do_set_cache_directory(self, arg):
+        "Keep the binary copies in a single directory instead"
+        directory = parse_args(arg, expected=1)[0]
+        pyasad.TextCache.directory = os.path.abspath(directory)
+        ok_print('Read cache directory set to: {}'.format(
+            pyasad.TextCache.directory))
+
+    def do_set_inplace(self, arg):
+        "Transform flux arrays in place instead of copying each value (Y/N)"
+        self.inplace = parse_yn(arg)
+        ok_print('In-place transforms set to: {}'.format(self.inplace))
+
+    def do_set_lazy(self, arg):
+        "Record transforms and run them in one pass when the flux is used (Y/N)"
+        self.lazy = parse_yn(arg)
+        for value in self.values:
+            value.lazy = self.lazy
+        ok_print('Lazy transforms set to: {}'.format(self.lazy))
+
+    def do_set_read_jobs(self, arg):
+        "Number of threads reading files of a directory"
+        self.read_jobs = max(1, parse_args(arg, expected=1, type=int)[0])
+        ok_print('Read jobs set to: {}'.format(self.read_jobs))
+
+    def read_value(self, path):
+        value = self.asad_type(path=path, wavelength_range=self.read_window)
+        value.lazy = self.lazy
+        return value
+
+    def try_read_value(self, path):
+        try:
+            return (self.read_value(path), None)
+        except Exception as err:
+            return (None, unicode(err))
+
+    def read_files(self, paths):
+        """Append the files in paths to values, in order.
+
+        With read_jobs above one the files are read by a thread pool and a
+        failing file is reported and skipped instead of stopping the read.
+        """
+        if self.read_jobs <= 1 or len(paths) <= 1:
+            for f in paths:
+                self.values.append(self.read_value(f))
+                ok_print("Read OK: {}".format(f))
+            return
+
+        start = time.time()
+        pool = multiprocessing.pool.ThreadPool(min(self.read_jobs, len(paths)))
+        try:
+            results = pool.map(self.try_read_value, paths)
+        finally:
+            pool.close()
+            pool.join()
+
+        (num_read, num_bytes) = (0, 0)
+        for (f, (value, err)) in zip(paths, results):
+            if err is not None:
+                error_print("Failed to read {}: {}".format(f, err))
+                continue
+            self.values.append(value)
+            num_read += 1
+            num_bytes += os.path.getsize(f)
+            ok_print("Read OK: {}".format(f))
+
+        elapsed = time.time() - start
+        info_print('Read {} of {} files, {:.1f} MB in {:.2f} s ({} threads)'.format(
+            num_read, len(paths), num_bytes / 2.0**20, elapsed,
+            min(self.read_jobs, len(paths))))
+        if num_read < len(paths):
+            error_print('{} files failed to read'.format(len(paths) - num_read))
+
+    @property
+    def inplace(self):
+        return self._inplace
+    @inplace.setter
+    def inplace(self, inplace):
+        self._inplace = inplace
+
+    @property
+    def lazy(self):
+        return self._lazy
+    @lazy.setter
+    def lazy(self, lazy):
+        self._lazy = lazy
+
+    @property
+    def read_jobs(self):
+        return self._read_jobs
+    @read_jobs.setter
+    def read_jobs(self, read_jobs):
+        self._read_jobs = read_jobs
+
+    @property
+    def read_window(self):
+        return self._read_window
+    @read_window.setter
+    def read_window(self, read_window):
+        self._read_window = read_window
+
 #===============================================================================
 
 class Model_Shell(Base_Shell):
@@ -436,7 +569,9 @@ class Model_Shell(Base_Shell):
     def do_read(self, arg, format='DELGADO'):
         try:
             path = os.path.abspath(parse_args(arg, expected=1)[0])
-            base = self.asad_type(path=path, format=format)
+            base = self.asad_type(path=path, format=format,
+                                  wavelength_range=self.read_window)
+            base.lazy = self.lazy
             self.values.append(base)
             ok_print("Read OK: {}".format(path))
             ok_print("Wavelength Step: {}".format(base.wavelength_step))
@@ -463,6 +598,15 @@ class Model_Shell(Base_Shell):
 class Observation_Shell(Base_Shell):
     asad_type = pyasad.Observation
 
+    def __init__(self, *args, **kwargs):
+        self._defer_reddening = False
+        super(Observation_Shell, self).__init__(*args, **kwargs)
+
+    def do_set_defer_reddening(self, arg):
+        "Rebuild reddened rows from one corrected spectrum instead of storing them (Y/N)"
+        self.defer_reddening = parse_yn(arg)
+        ok_print('Defer reddening set to: {}'.format(self.defer_reddening))
+
     def do_set_reddening_step(self, arg):
         reddening_step = parse_args(arg, expected=1, type=float)[0]
         for obsv in self.values:
@@ -476,8 +620,20 @@ class Observation_Shell(Base_Shell):
     def do_redshift(self, arg):
         try:
             [start, end, step] = parse_args(arg, expected=3, type=float)
-            for (i, observation) in enumerate(self.values):
-                self.values[i] = observation.reddening_shift(start, end, step)
+            if self.inplace:
+                # Replace one at a time so each unreddened value is freed
+                for (i, obsv) in enumerate(self.values):
+                    self.values[i] = obsv.reddening_shift(
+                        start, end, step, defer=self.defer_reddening)
+                shifted = self.values
+            elif self.defer_reddening:
+                shifted = [obsv.reddening_shift(start, end, step, defer=True)
+                           for obsv in self.values]
+            else:
+                shifted = pyasad.Observation.reddening_shift_many(
+                    self.values, start, end, step)
+            self.values[:] = shifted
+            for observation in self.values:
                 ok_print('Reddening Corrected: {}'.format(observation.name))
         except ValueError as value_error:
             error_print('Redshift: start end step needed')
@@ -499,6 +655,13 @@ class Observation_Shell(Base_Shell):
             error_print("Redshift: start must be a float")
             raise type_error
 
+    @property
+    def defer_reddening(self):
+        return self._defer_reddening
+    @defer_reddening.setter
+    def defer_reddening(self, defer_reddening):
+        self._defer_reddening = defer_reddening
+
 #===============================================================================
 
 class Plot_Shell(Shell):
@@ -513,6 +676,19 @@ class Object_Shell(Base_Shell):
         self._base = Base_Shell()
         self._model = Model_Shell()
         self._observation = Observation_Shell()
+        self._stat_engine = pyasad.Asad.STAT_ENGINES[0]
+        self._max_memory_mb = pyasad.Asad.MAX_MEMORY_MB
+        self._jobs = 1
+        self._search = pyasad.Asad.SEARCH_MODES[0]
+        self._coarse_candidates = pyasad.Asad.COARSE_CANDIDATES
+        self._precision = pyasad.Asad.PRECISIONS[0]
+        self._plot_jobs = 1
+        self._bundles = {}
+        self._keep_bundles = False
+        self._keep_pool = False
+        self._pool = None
+        self._store = None
+        self._kept_bases = {}
         super(Object_Shell, self).__init__(*args, **kwargs)
 
     def do_new(self, arg):
@@ -531,7 +707,7 @@ class Object_Shell(Base_Shell):
         for obj in self.values:
             pprint(obj.name)
 
-    def do_calculate_chosen_model(self, arg):
+    def do_calculate_chosen_model(self, arg, shells=None):
         try:
             stat_test = pyasad.Statistics.ks_2_sample_freq_test if arg == 'ks' else pyasad.Statistics.chi_squared_freq_test
             for obj in self.values:
@@ -543,13 +719,167 @@ class Object_Shell(Base_Shell):
                              obj.num_observation, obj.num_model
                          ))
                 obj.stat_test = stat_test
+                obj.engine = self.stat_engine
+                obj.max_memory_mb = self.max_memory_mb
+                obj.search = self.search
+                obj.coarse_candidates = self.coarse_candidates
+            self.convert_precision(shells)
+            if self.jobs > 1 and len(self.values) > 1:
+                self.calculate_chosen_model_parallel()
+                return
+            for obj in self.values:
                 obj.calculate_chosen_model()
-                ok_print('Calculated Min Age and Reddening: %s' % obj.name)
+                self.print_calculated(obj)
         except Exception as err:
             error_print('Error calculating best Reddening/Age match')
             error_print(unicode(err))
             raise err
 
+    def convert_precision(self, shells=None):
+        """Store the observations and models of the objects at precision.
+
+        Every base is converted once, and replaces its original in shells,
+        the model and observation shells holding the bases (by default
+        this shell's own), so no double precision copy is kept next to it.
+        """
+        dtype = pyasad.Asad.precision_dtype(self.precision)
+        converted = {}
+        for shell in shells or (self.model, self.observation):
+            for (i, base) in enumerate(shell.values):
+                converted[id(base)] = shell.values[i] = base.astype(dtype)
+        for obj in self.values:
+            for name in ('observation', 'model'):
+                base = getattr(obj, name)
+                if id(base) not in converted:
+                    converted[id(base)] = base.astype(dtype)
+                setattr(obj, name, converted[id(base)])
+
+    def calculate_chosen_model_parallel(self):
+        """Fit every object in a process pool, a failing object is reported
+        and dropped from the objects, so later commands see only fits.
+
+        The pool is closed afterwards unless keep_pool is set, streamed
+        observations then share one pool and store until close_pool.
+        """
+        if self.keep_pool:
+            if self._pool is None:
+                self._store = shared.SharedStore()
+                self._pool = multiprocessing.Pool(self.jobs)
+            results = self.fit_parallel(self._pool, self._store)
+        else:
+            with shared.SharedStore() as store:
+                pool = multiprocessing.Pool(min(self.jobs, len(self.values)))
+                try:
+                    results = self.fit_parallel(pool, store)
+                finally:
+                    pool.close()
+                    pool.join()
+
+        fitted = []
+        for (obj, (fit, err)) in zip(self.values, results):
+            if err is not None:
+                error_print('Error calculating {}: {}'.format(obj.name, err))
+            else:
+                obj.set_fit(fit)
+                self.print_calculated(obj)
+                fitted.append(obj)
+        if len(fitted) < len(self.values):
+            error_print('{} of {} objects failed and were dropped'.format(
+                len(self.values) - len(fitted), len(self.values)))
+        self.values = fitted
+
+    def fit_parallel(self, pool, store):
+        """fit_object of every object in pool, bases shared through store.
+
+        With keep_pool the models stay shared until close_pool, so a model
+        stack used for many observations is written only once, the
+        observations are removed from the store once fitted.
+        """
+        bases = dict((id(base), base) for obj in self.values
+                     for base in (obj.observation, obj.model))
+        kept = set()
+        if self.keep_pool:
+            kept = set(id(obj.model) for obj in self.values)
+        for base in bases.values():
+            base.share(store)
+        try:
+            return pool.map(fit_object, self.values, chunksize=1)
+        finally:
+            for (key, base) in bases.items():
+                if key in kept:
+                    self._kept_bases[key] = base
+                else:
+                    base.unshare(store)
+
+    def close_pool(self):
+        if self._pool is None:
+            return
+        self._pool.close()
+        self._pool.join()
+        for base in self._kept_bases.values():
+            base.unshare()
+        self._store.close()
+        (self._pool, self._store, self._kept_bases) = (None, None, {})
+
+    def print_calculated(self, obj):
+        ok_print('Calculated Min Age and Reddening: %s' % obj.name)
+        if obj.engine == 'tiled':
+            info_print('Tile size: {} x {}'.format(*obj.tile_size))
+        if obj.search == 'coarse':
+            info_print('Evaluated {} of {} cells'.format(
+                obj.evaluated_cells, obj.num_observation * obj.num_model))
+
+    def do_set_stat_engine(self, arg):
+        engine = parse_args(arg, expected=1)[0]
+        if engine not in pyasad.Asad.STAT_ENGINES:
+            error_print('Unknown engine: {}, choose from: {}'.format(
+                engine, ', '.join(pyasad.Asad.STAT_ENGINES)))
+            return
+        self.stat_engine = engine
+        ok_print('Statistic engine set to: {}'.format(engine))
+
+    def do_set_search(self, arg):
+        search = parse_args(arg, expected=1)[0]
+        if search not in pyasad.Asad.SEARCH_MODES:
+            error_print('Unknown search: {}, choose from: {}'.format(
+                search, ', '.join(pyasad.Asad.SEARCH_MODES)))
+            return
+        self.search = search
+        ok_print('Search set to: {}'.format(search))
+
+    def do_set_coarse_candidates(self, arg):
+        "Best cells refined at every level of the coarse search"
+        candidates = parse_args(arg, expected=1, type=int)[0]
+        if candidates < 1:
+            error_print('Coarse candidates must be at least 1, given: {}'.format(
+                candidates))
+            return
+        self.coarse_candidates = candidates
+        ok_print('Coarse candidates set to: {}'.format(candidates))
+
+    def do_set_precision(self, arg):
+        "Store fluxes in double or single precision while fitting"
+        precision = parse_args(arg, expected=1)[0]
+        if precision not in pyasad.Asad.PRECISIONS:
+            error_print('Unknown precision: {}, choose from: {}'.format(
+                precision, ', '.join(pyasad.Asad.PRECISIONS)))
+            return
+        self.precision = precision
+        ok_print('Precision set to: {}'.format(precision))
+
+    def do_set_jobs(self, arg):
+        self.jobs = max(1, parse_args(arg, expected=1, type=int)[0])
+        ok_print('Jobs set to: {}'.format(self.jobs))
+
+    def do_set_plot_jobs(self, arg):
+        "Number of processes drawing the per-object plots"
+        self.plot_jobs = max(1, parse_args(arg, expected=1, type=int)[0])
+        ok_print('Plot jobs set to: {}'.format(self.plot_jobs))
+
+    def do_set_max_memory_mb(self, arg):
+        self.max_memory_mb = parse_args(arg, expected=1, type=float)[0]
+        ok_print('Maximum memory set to: {} MB'.format(self.max_memory_mb))
+
     def do_chosen(self, arg):
         if not self.values:
             print('Empty')
@@ -570,79 +900,149 @@ class Object_Shell(Base_Shell):
         print(sep)
 
     def do_write_chosen(self, arg, config=None):
-
-        def write_chosen(path, values):
-            with io.open(path, 'w') as f:
-                for obj in values:
-                    f.write(obj.format_chosen())
-                    ok_print('Wrote %s to %s' % (obj.name, path))
-                if config:
-                    buff = StringIO()
-                    buff.write(unicode('\n'))
-                    config.write(buff)
-                    f.write(unicode(buff.getvalue()))
-
         path = os.path.abspath(parse_args(arg, expected=1)[0])
         if os.path.isdir(path):
             for obj in self.values:
-                fpath = os.path.join(path, config['object_test_statistic']
-                    + '_' + 'result_of_%s' % obj.name)
-                write_chosen(fpath, [obj])
+                self.write_chosen(
+                    Object_Shell.chosen_path(path, obj, config), [obj], config)
         else:
-            write_chosen(path, self.values)
+            self.write_chosen(path, self.values, config)
+
+    @staticmethod
+    def chosen_path(directory, obj, config):
+        return os.path.join(directory, config['object_test_statistic']
+            + '_' + 'result_of_%s' % obj.name)
+
+    def write_chosen(self, path, values, config=None):
+        with io.open(path, 'w') as f:
+            for obj in values:
+                f.write(obj.format_chosen())
+                ok_print('Wrote %s to %s' % (obj.name, path))
+            if config:
+                self.write_chosen_config(f, config)
+
+    @staticmethod
+    def write_chosen_config(f, config):
+        buff = StringIO()
+        buff.write(unicode('\n'))
+        config.write(buff)
+        f.write(unicode(buff.getvalue()))
 
     @base_command
     def do_plot(self, arg):
         pass
 
     def do_plot_surface(self, arg, format='', title=None):
-        try:
-            path = os.path.abspath(parse_args(arg, expected=1)[0])
-            if not os.path.isdir(path):
-                raise RuntimeError('Must be a directory')
-            for obj in self.values:
-                plot.surface(obj, outdir=path, save=True, format=format, title=title)
-                ok_print('Plotted surface %s to %s' % (obj.name, path))
-        except Exception as err:
-            error_print(unicode(err))
-            raise err
+        self.plot_objects('surface', arg, format=format, title=title)
 
     def do_plot_scatter(self, arg, ages=[], reddenings=[], format='', title=None):
-        try:
-            path = os.path.abspath(parse_args(arg, expected=1)[0])
-            if not os.path.isdir(path):
-                raise RuntimeError('Must be a directory')
-            for obj in self.values:
-                plot.scatter(obj, ages=ages, reddenings=reddenings,
-                             outdir=path, save=True, format=format, title=title)
-                ok_print('Plotted scatter %s to %s' % (obj.name, path))
-        except Exception as err:
-            error_print(unicode(err))
-            raise err
+        self.plot_objects('scatter', arg, ages=ages, reddenings=reddenings,
+                          format=format, title=title)
 
     def do_plot_residual_match(self, arg, format='', title=None):
+        self.plot_objects('residual_match', arg, format=format, title=title)
+
+    def do_plot_residual(self, arg, format='', title=None):
+        self.plot_objects('residual', arg, format=format, title=title)
+
+    def plot_objects(self, kind, arg, **kwargs):
+        "Draw the plot.PLOTS[kind] figure of every object into a directory"
         try:
             path = os.path.abspath(parse_args(arg, expected=1)[0])
             if not os.path.isdir(path):
                 raise RuntimeError('Must be a directory')
+            label = kind.replace('_', ' ')
+            if kwargs.get('format') == plot.BUNDLE_FORMAT:
+                self.plot_objects_bundle(kind, path, label, **kwargs)
+                return
+            if self.plot_jobs > 1 and len(self.values) > 1:
+                self.plot_objects_parallel(kind, path, label, **kwargs)
+                return
+            draw = self.plot_drawer(kind)
             for obj in self.values:
-                plot.residual_match(obj, outdir=path, save=True, format=format, title=title)
-                ok_print('Plotted residual match %s to %s' % (obj.name, path))
+                draw(obj, outdir=path, save=True, **kwargs)
+                ok_print('Plotted %s %s to %s' % (label, obj.name, path))
         except Exception as err:
             error_print(unicode(err))
             raise err
 
-    def do_plot_residual(self, arg, format='', title=None):
+    def plot_drawer(self, kind):
+        if kind == 'surface' and len(self.values) > 1:
+            # One figure for all surfaces, only the contours are redrawn
+            return plot.SurfaceRenderer().render
+        return plot.PLOTS[kind]
+
+    def plot_objects_bundle(self, kind, path, label, **kwargs):
+        """Add the figures as pages of the plot.PdfBundle of kind in path.
+
+        Pages are written in order, so plot_jobs is not used. The bundle is
+        closed afterwards unless keep_bundles is set, streamed observations
+        then share one bundle until close_bundles.
+        """
+        del kwargs['format']
+        bundle = self.bundle(kind, path)
         try:
-            path = os.path.abspath(parse_args(arg, expected=1)[0])
-            if not os.path.isdir(path):
-                raise RuntimeError('Must be a directory')
+            draw = self.plot_drawer(kind)
             for obj in self.values:
-                plot.residual(obj, outdir=path, save=True, format=format, title=title)
-                ok_print('Plotted residual %s to %s' % (obj.name, path))
-        except Exception as err:
-            error_print(unicode(err))
-            raise err
+                bundle.add(obj, draw(obj, **kwargs))
+                ok_print('Plotted %s %s to %s' % (label, obj.name, bundle.path))
+        finally:
+            if not self.keep_bundles:
+                self.close_bundles()
+
+    def bundle(self, kind, path):
+        "The open bundle of kind, a new one if there is none in path"
+        file_path = os.path.join(path, plot.BUNDLE_NAMES[kind] + '.pdf')
+        bundle = self._bundles.get(kind)
+        if bundle is not None and bundle.path != file_path:
+            self.close_bundle(kind)
+            bundle = None
+        if bundle is None:
+            bundle = plot.PdfBundle(file_path, title=kind.replace('_', ' '))
+            self._bundles[kind] = bundle
+        return bundle
+
+    def close_bundle(self, kind):
+        bundle = self._bundles.pop(kind)
+        bundle.close()
+        ok_print('Wrote {} {} pages and their index to {}'.format(
+            bundle.num, bundle.title, bundle.path))
+
+    def close_bundles(self):
+        for kind in list(self._bundles):
+            self.close_bundle(kind)
+
+    def plot_objects_parallel(self, kind, path, label, **kwargs):
+        """Draw the figures in a process pool, a failing figure is only reported.
+
+        Workers receive a plot.PlotData per object, not the object itself.
+        """
+        start = time.time()
+        kwargs = dict(kwargs, outdir=path, save=True)
+        tasks = [(kind, plot.PlotData.for_plot(kind, obj, **kwargs), kwargs)
+                 for obj in self.values]
+        processes = min(self.plot_jobs, len(tasks))
+        pool = multiprocessing.Pool(processes)
+        try:
+            errors = pool.map(plot.render, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        failed = 0
+        for (obj, err) in zip(self.values, errors):
+            if err is not None:
+                failed += 1
+                error_print('Error plotting {} {}: {}'.format(label, obj.name, err))
+            else:
+                ok_print('Plotted %s %s to %s' % (label, obj.name, path))
+        elapsed = time.time() - start
+        info_print('Plotted {} {} figures in {:.2f} s, {:.1f} figures/s ({} processes)'.format(
+            len(tasks) - failed, label, elapsed,
+            (len(tasks) - failed) / max(elapsed, 1e-9), processes))
+        if failed:
+            error_print('{} of {} figures failed'.format(failed, len(tasks)))
+
     #test
     def do_plot_surface_error(self, arg, format=''):
         try:
@@ -717,6 +1117,69 @@ class Object_Shell(Base_Shell):
     def model(self):
         return self._model
 
+    @property
+    def stat_engine(self):
+        return self._stat_engine
+    @stat_engine.setter
+    def stat_engine(self, stat_engine):
+        self._stat_engine = stat_engine
+
+    @property
+    def max_memory_mb(self):
+        return self._max_memory_mb
+    @max_memory_mb.setter
+    def max_memory_mb(self, max_memory_mb):
+        self._max_memory_mb = max_memory_mb
+
+    @property
+    def search(self):
+        return self._search
+    @search.setter
+    def search(self, search):
+        self._search = search
+
+    @property
+    def coarse_candidates(self):
+        return self._coarse_candidates
+    @coarse_candidates.setter
+    def coarse_candidates(self, coarse_candidates):
+        self._coarse_candidates = coarse_candidates
+
+    @property
+    def plot_jobs(self):
+        return self._plot_jobs
+    @plot_jobs.setter
+    def plot_jobs(self, plot_jobs):
+        self._plot_jobs = plot_jobs
+
+    @property
+    def keep_bundles(self):
+        return self._keep_bundles
+    @keep_bundles.setter
+    def keep_bundles(self, keep_bundles):
+        self._keep_bundles = keep_bundles
+
+    @property
+    def keep_pool(self):
+        return self._keep_pool
+    @keep_pool.setter
+    def keep_pool(self, keep_pool):
+        self._keep_pool = keep_pool
+
+    @property
+    def precision(self):
+        return self._precision
+    @precision.setter
+    def precision(self, precision):
+        self._precision = precision
+
+    @property
+    def jobs(self):
+        return self._jobs
+    @jobs.setter
+    def jobs(self, jobs):
+        self._jobs = jobs
+
     @property
     def observation(self):
         return self._observation
@@ -747,11 +1210,37 @@ def prompt_command(func):
 #-------------------------------------------------------------------------------
 
 class Run_Shell(Object_Shell):
+    READ_WINDOW_MARGIN = 4
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, jobs=None, precision=None, *args, **kwargs):
         self.object = Object_Shell()
         self.config = GlobalConfig()
+        self.object.jobs = jobs or int(self.config.get('object_jobs', 1))
+        self.object.precision = precision or self.config.get(
+            'object_precision', pyasad.Asad.PRECISIONS[0])
+        self.object.plot_jobs = max(1, int(self.config.get('plot_jobs', 1)))
+        self.object.stat_engine = self.config.get(
+            'object_stat_engine', pyasad.Asad.STAT_ENGINES[0])
+        self.object.max_memory_mb = float(self.config.get(
+            'object_max_memory_mb', pyasad.Asad.MAX_MEMORY_MB))
+        self.object.search = self.config.get(
+            'object_search', pyasad.Asad.SEARCH_MODES[0])
+        self.object.coarse_candidates = max(1, int(self.config.get(
+            'object_coarse_candidates', pyasad.Asad.COARSE_CANDIDATES)))
         super(Run_Shell, self).__init__(*args, **kwargs)
+        self.observation.defer_reddening = parse_yn(self.config.get(
+            'observation_defer_reddening', 'N'))
+        self.observation.read_jobs = max(1, int(self.config.get(
+            'observation_read_jobs', 1)))
+        inplace = parse_yn(self.config.get('choices_inplace_transforms', 'N'))
+        self.observation.inplace = inplace
+        self.model.inplace = inplace
+        lazy = parse_yn(self.config.get('choices_lazy_plan', 'N'))
+        self.observation.lazy = lazy
+        self.model.lazy = lazy
+        pyasad.TextCache.enabled = parse_yn(self.config.get(
+            'cache_enabled', 'N'))
+        pyasad.TextCache.directory = self.config.get('cache_directory') or None
 
     def update_config(self):
         self.config.write_config_file()
@@ -827,11 +1316,25 @@ class Run_Shell(Object_Shell):
             'Model path',
             self.config['model_input_directory']
         )
+        self.model.read_window = self.config_read_window()
         self.model.do_read(
             self.config['model_input_directory'],
             format=self.config['model_format']
         )
 
+    def config_read_window(self):
+        """Rows of a spectrum the run can use, or None to read all of them.
+
+        Everything is cut to the observation range, widened here by a few
+        interpolation steps for the smoothing windows around it.
+        """
+        if not parse_yn(self.config.get('model_read_window', 'Y'), default=True):
+            return None
+        margin = Run_Shell.READ_WINDOW_MARGIN * float(
+            self.config['observation_interpolation_step'])
+        return (float(self.config['observation_wavelength_start']) - margin,
+                float(self.config['observation_wavelength_end']) + margin)
+
     @prompt_command
     def model_age_start_and_step(self):
         self.config['model_age_start'] = safe_default_input(
@@ -1041,7 +1544,9 @@ class Run_Shell(Object_Shell):
         self.config['object_test_statistic'] = stat_test
         print('Calculating best match of age and reddening ({})...'.format(
             self.config['object_test_statistic']))
-        self.object.do_calculate_chosen_model(self.config['object_test_statistic'])
+        self.object.do_calculate_chosen_model(
+            self.config['object_test_statistic'],
+            shells=(self.model, self.observation))
 
     @prompt_command
     def object_output_chosen(self):
@@ -1054,7 +1559,8 @@ class Run_Shell(Object_Shell):
     @prompt_command
     def plot_output_format(self):
         self.config['plot_output_format'] = safe_default_input(
-            'Plot output format',
+            'Plot output format, {} for one PDF per plot kind'.format(
+                plot.BUNDLE_FORMAT),
             self.config['plot_output_format'])
 
     @prompt_command
@@ -1154,6 +1660,144 @@ class Run_Shell(Object_Shell):
         self.object.do_plot_surface_tile(self.config['plot_surface_tile_directory'],
                                          format=self.config['plot_output_format'])
 
+    def stream(self):
+        """Fit the observations one at a time using the saved configuration.
+
+        The model is prepared once, then every observation is read, cut,
+        smoothed, reddened, normalized, fitted, written and plotted before
+        the next one is read, so memory does not grow with the survey.
+        """
+        info_print("ASAD: Analyzer of Spectra for Age Determination")
+        info_print("Streaming mode.")
+        self.stream_model()
+        paths = self.stream_paths()
+        stat_test = self.config['object_test_statistic']
+        chosen = self.stream_chosen_writer()
+        next(chosen)
+
+        start = time.time()
+        (num_fitted, failed) = (0, [])
+        # A pdf_bundle output_format collects the whole run in one bundle,
+        # one fitting pool serves every observation
+        self.object.keep_bundles = True
+        self.object.keep_pool = True
+        try:
+            for (path, objs) in self.stream_objects(paths, failed):
+                try:
+                    self.object.values = objs
+                    self.object.do_calculate_chosen_model(
+                        stat_test, shells=(self.model, self.observation))
+                    # Objects that failed to fit are dropped from values
+                    for obj in self.object.values:
+                        chosen.send(obj)
+                    self.stream_plots()
+                    num_fitted += 1
+                except Exception as err:
+                    error_print('Failed to fit {}: {}'.format(path, unicode(err)))
+                    failed.append(path)
+                finally:
+                    self.object.values = []
+        finally:
+            self.object.keep_pool = False
+            self.object.close_pool()
+            self.object.keep_bundles = False
+            self.object.close_bundles()
+        chosen.close()
+
+        info_print('Fitted {} of {} observations in {:.2f} s'.format(
+            num_fitted, len(paths), time.time() - start))
+        if failed:
+            error_print('{} observations failed'.format(len(failed)))
+
+    def stream_model(self):
+        """Read and prepare the model as the assistant would, without prompts"""
+        self.model.read_window = self.config_read_window()
+        self.model.do_read(self.config['model_input_directory'],
+                           format=self.config['model_format'])
+        if parse_yn(self.config['choices_set_age_start_and_step']):
+            self.model.do_set_age_start(self.config['model_age_start'])
+            self.model.do_set_age_step(self.config['model_age_step'])
+        if parse_yn(self.config['choices_smooth_observation']):
+            self.model_interpolation_wavelength_start_2()
+            self.model_smoothen()
+        self.model_wavelength_range()
+        if parse_yn(self.config['choices_normalize_wavelength']):
+            if parse_yn(self.config['choices_wavelength_normalization']):
+                self.model_normalize_wavelength()
+            else:
+                self.model_normalize_average()
+        # Converted once here instead of once per streamed observation
+        dtype = pyasad.Asad.precision_dtype(self.object.precision)
+        self.model.values = [model.astype(dtype) for model in self.model.values]
+
+    def stream_paths(self):
+        path = os.path.abspath(self.config['observation_input_directory'])
+        if os.path.isdir(path):
+            return list_files(path)
+        elif os.path.isfile(path):
+            return [path]
+        return glob.glob(path)
+
+    def stream_observations(self, paths, failed):
+        """Prepared observations, one path at a time"""
+        self.observation.read_window = self.config_read_window()
+        for path in paths:
+            self.observation.values = []
+            try:
+                self.observation.do_read(path)
+                self.previousAnalysisObservation()
+            except Exception as err:
+                error_print('Failed to prepare {}: {}'.format(path, unicode(err)))
+                failed.append(path)
+                continue
+            for obsv in self.observation.values:
+                yield (path, obsv)
+            self.observation.values = []
+
+    def stream_objects(self, paths, failed):
+        for (path, obsv) in self.stream_observations(paths, failed):
+            yield (path, [pyasad.Asad.from_observation_model(obsv, model)
+                          for model in self.model.values])
+
+    def stream_chosen_writer(self):
+        """Coroutine writing every object sent to it to the chosen output.
+
+        A directory gets one file per object as do_write_chosen does, a
+        file is kept open and appended to, the configuration goes last.
+        """
+        path = os.path.abspath(self.config['object_chosen_directory'])
+        if os.path.isdir(path):
+            while True:
+                obj = (yield)
+                self.object.write_chosen(
+                    Object_Shell.chosen_path(path, obj, self.config),
+                    [obj], self.config)
+
+        with io.open(path, 'w') as f:
+            try:
+                while True:
+                    obj = (yield)
+                    f.write(obj.format_chosen())
+                    ok_print('Wrote %s to %s' % (obj.name, path))
+            except GeneratorExit:
+                Object_Shell.write_chosen_config(f, self.config)
+
+    def stream_plots(self):
+        """The per object plots enabled in the configuration"""
+        format = self.config['plot_output_format']
+        if parse_yn(self.config['choices_output_surface_plots']):
+            self.object.do_plot_surface(
+                self.config['plot_surface_directory'], format=format)
+        if parse_yn(self.config['choices_output_best_spectra_match_plots']):
+            self.object.do_plot_scatter(
+                self.config['plot_scatter_directory'], format=format)
+        if parse_yn(self.config['choices_output_residual_plots']):
+            self.object.do_plot_residual_match(
+                self.config['plot_residual_match_directory'], format=format)
+        if parse_yn(self.config['choices_output_detailed_residual_plots']):
+            self.object.do_plot_residual(
+                self.config['plot_residual_directory'], format=format)
+
     def cmdloop(self):
         observation_is_smoothed = False
         info_print("ASAD: Analyzer of Spectra for Age Determination")
@@ -1347,8 +1991,10 @@ class Main_Shell(cmd.Cmd):
     intro = "Welcome. Type ? for help."
     prompt = "<pyasad> "
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, jobs=None, precision=None, *args, **kwargs):
         self._object = Object_Shell()
+        self._object.jobs = jobs or 1
+        self._object.precision = precision or pyasad.Asad.PRECISIONS[0]
         cmd.Cmd.__init__(self, *args, **kwargs)
 
     def execute(self, path):
@@ -1389,7 +2035,8 @@ class Main_Shell(cmd.Cmd):
     def do_object(self, arg):
         return self.object.onecmd(arg)
     def do_run(self, arg):
-        return Run_Shell().cmdloop()
+        return Run_Shell(jobs=self.object.jobs,
+                         precision=self.object.precision).cmdloop()
     def do_quit(self, arg):
         print('Quitting')
         sys.exit(0)
@@ -1,4 +1,6 @@
+import copy
 import os.path, re, sys
+import threading
 from itertools import cycle
 
 import numpy              as np
@@ -6,8 +8,26 @@ import matplotlib         as mpl
 mpl.use('Agg')
 
 import matplotlib.cm      as cm
-import matplotlib.pyplot  as plt
+import matplotlib.colorbar
+import matplotlib.gridspec as gridspec
 import matplotlib.markers as markers
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.figure import Figure
+
+# Every figure is a Figure with its own Agg canvas, drawn through its
+# Axes, pyplot and the global rcParams are never touched, so figures can
+# be rendered from several threads at once. Styles are passed explicitly.
+# matplotlib shares FreeType fonts between threads though: whatever
+# measures or draws text holds RENDER_LOCK, building figures does not.
+RENDER_LOCK = threading.RLock()
+
+# plot output_format value collecting the figures of a kind in a PdfBundle
+BUNDLE_FORMAT = 'pdf_bundle'
+
+# Spectra are decimated to the columns a figure this wide has at this dpi,
+# enough for print and above the 100 dpi raster output
+DECIMATE_DPI = 300
 
 options = {
     'xtick.labelsize'         : 28,
@@ -49,102 +69,222 @@ def title_format(obj):
     observation_name = observation_name_format(obj.observation.original_name)
     return '[ {} with {} ]'.format(observation_name, model_name)
 
+def new_figure(**kwargs):
+    "Figure with its own Agg canvas, unknown to pyplot"
+    fig = Figure(**kwargs)
+    FigureCanvasAgg(fig)
+    return fig
+
+def save_figure(fig, outdir, file_name, format, **kwargs):
+    # Figures saved outside of a PdfBundle are single page PDFs
+    if format == BUNDLE_FORMAT:
+        format = 'pdf'
+    with RENDER_LOCK:
+        fig.savefig(
+            os.path.abspath(os.path.join(outdir, file_name)) + "." + format,
+            format=format, **kwargs)
+
+def stacked_axes(fig, num):
+    """num axes in one column sharing x and y, x tick labels only on the
+    last, as pyplot.subplots(num, sharex=True, sharey=True) makes them"""
+    first = fig.add_subplot(num, 1, 1)
+    axes = [first] + [fig.add_subplot(num, 1, i + 1, sharex=first, sharey=first)
+                      for i in range(1, num)]
+    for ax in axes[:-1]:
+        for label in ax.get_xticklabels():
+            label.set_visible(False)
+        ax.xaxis.offsetText.set_visible(False)
+    return axes
+
+def apply_style(axes, style=None):
+    "Tick settings of an rcParams-like style such as options, on axes only"
+    if not style:
+        return
+    for ax in axes:
+        for name in ('x', 'y'):
+            tick = lambda key, default=None: style.get(
+                '{}tick.{}'.format(name, key), default)
+            ax.tick_params(axis=name, labelsize=tick('labelsize'))
+            for which in ('major', 'minor'):
+                ax.tick_params(axis=name, which=which,
+                               length=tick(which + '.size'),
+                               width=tick(which + '.width'))
+
+def decimate_line(x, y, columns):
+    """(x, y) of a line keeping the first, last, min and max points of each
+    of columns equal x intervals, in order.
+
+    Rasterized at one pixel per column this draws the same pixels as the
+    full line, so the points plotted no longer grow with the resolution
+    of the spectrum. Lines with few points, or x not increasing, are
+    returned as they are.
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    n = len(x)
+    if columns < 1 or n <= 4 * columns or not x[-1] > x[0] \
+       or np.any(np.diff(x) < 0):
+        return (x, y)
+    column = ((x - x[0]) * (columns / float(x[-1] - x[0]))).astype(int)
+    np.minimum(column, columns - 1, out=column)
+    first = np.flatnonzero(np.r_[True, column[1:] != column[:-1]])
+    last = np.r_[first[1:] - 1, n - 1]
+    # Sorted by column then y, every column is a run starting at first
+    order = np.lexsort((y, column))
+    keep = np.unique(np.concatenate((first, last, order[first], order[last])))
+    return (x[keep], y[keep])
+
+def line_columns(fig, decimate=True):
+    "Columns decimate_line keeps on fig, 0 to keep every point"
+    return int(fig.get_figwidth() * DECIMATE_DPI) if decimate else 0
+
+def surface_colormap():
+    "jet with under/over colors, a copy so the shared colormap is untouched"
+    cmap = copy.copy(cm.jet)
+    cmap.set_under('k')
+    cmap.set_over('w')
+    return cmap
+
 def surface(obj, levels=15, outdir="",
             fname='',
             format='eps',
             labels=False,
             save=False,
-            show=False,
             title=None,
+            style=None,
             *args, **kwargs):
-    
-
-    mpl.rcParams = dict(mpl.rcParams, **options)
     NL = levels
     x  = obj.model.age
     y  = obj.observation.reddening
     z  = 1.0 / np.array(obj.stat)
 
-    fig = plt.figure(figsize=(16,10))
-    border_width = 0.10
-    border_height = 0.09
+    fig = new_figure(figsize=(16,10))
     ax_size = [0.10, 0.15, 0.90, 0.75]
     ax = fig.add_axes(ax_size)
 
-    C  = plt.contour(x, y, z, NL, colors=['k'], linewidths=0.10, zorder=2)
-    if labels: plt.clabel(C, inline=1, linewidths=0.10, **small_font)
-    CF = plt.contourf(x, y, z, NL, alpha=0.85, cmap=cm.jet, zorder=1)
-    CF.cmap.set_under('k')
-    CF.cmap.set_over('w')
-    cb = fig.colorbar(CF)
+    C  = ax.contour(x, y, z, NL, colors=['k'], linewidths=0.10, zorder=2)
+    if labels:
+        with RENDER_LOCK:
+            ax.clabel(C, inline=1, linewidths=0.10, **small_font)
+    CF = ax.contourf(x, y, z, NL, alpha=0.85, cmap=surface_colormap(), zorder=1)
+    cb = fig.colorbar(CF, ax=ax)
+    apply_style([ax, cb.ax], style)
     cb.ax.tick_params(labelsize=26)
     cb.set_label("Test Statistic", size=32)
-    plt.scatter([obj.min_age], [obj.min_reddening], c='w', s=350, marker="*", zorder=3)
+    ax.scatter([obj.min_age], [obj.min_reddening], c='w', s=350, marker="*", zorder=3)
 
-    plt.xlim(xmin=obj.model.age[0], xmax=obj.model.age[-1])
-    plt.ylim([obj.observation.reddening[0], obj.observation.reddening[-1]])
+    ax.set_xlim(x[0], x[-1])
+    ax.set_ylim([y[0], y[-1]])
 
     if title:
-      plt.title(title, **font)
+      ax.set_title(title, **font)
     else:
-      plt.title(title_format(obj), **font)
-    
-    plt.xlabel("log(Age/Year)", **font)
-    plt.ylabel("E (B-V)", **font)
+      ax.set_title(title_format(obj), **font)
+
+    ax.set_xlabel("log(Age/Year)", **font)
+    ax.set_ylabel("E (B-V)", **font)
 
-    plt.tick_params(labelsize=26)
-    plt.minorticks_on()
-    plt.grid(which='both')
+    ax.tick_params(labelsize=26)
+    ax.minorticks_on()
+    ax.grid(which='both')
 
     file_name = fname or ("surface_" + obj.name)
     if save:
-        plt.savefig(
-            os.path.abspath(os.path.join(outdir, file_name)) + "." + format,
-            format=format,
-            bbox_inches=0
-        )
-
-    if show:
-        plt.show()
-    plt.close()
-
-def surface_subplot(obj, levels=15,
+        save_figure(fig, outdir, file_name, format, bbox_inches=0)
+    return fig
+
+class SurfaceRenderer(object):
+    """Draws surface figures one after another on a single figure.
+
+    Axes, labels, grid, colorbar axes and the star marker are built once,
+    every render only swaps the contour sets, moves the star and retitles
+    before saving. Objects are expected to share their age and reddening
+    grid, the limits are reset to each object's axes anyway.
+    """
+
+    def __init__(self, levels=15, labels=False, style=None):
+        self.levels = levels
+        self.labels = labels
+        self.style = style
+        self.fig = new_figure(figsize=(16,10))
+        self.ax = self.fig.add_axes([0.10, 0.15, 0.90, 0.75])
+        # The space fig.colorbar(ax=ax) would take, claimed once
+        (self.cax, self.cbar_kw) = mpl.colorbar.make_axes(self.ax)
+        self.contours = []
+        self.star = self.ax.scatter([0], [0], c='w', s=350, marker="*", zorder=3)
+        apply_style([self.ax], style)
+        self.ax.set_xlabel("log(Age/Year)", **font)
+        self.ax.set_ylabel("E (B-V)", **font)
+        self.ax.tick_params(labelsize=26)
+        self.ax.minorticks_on()
+        self.ax.grid(which='both')
+
+    @staticmethod
+    def remove_contours(cs):
+        for collection in cs.collections:
+            collection.remove()
+        for text in cs.labelTexts:
+            text.remove()
+
+    def render(self, obj, outdir='', fname='', format='eps', save=False,
+               title=None, *args, **kwargs):
+        x  = obj.model.age
+        y  = obj.observation.reddening
+        z  = 1.0 / np.array(obj.stat)
+        (ax, NL) = (self.ax, self.levels)
+
+        for cs in self.contours:
+            SurfaceRenderer.remove_contours(cs)
+        C  = ax.contour(x, y, z, NL, colors=['k'], linewidths=0.10, zorder=2)
+        if self.labels:
+            with RENDER_LOCK:
+                ax.clabel(C, inline=1, linewidths=0.10, **small_font)
+        CF = ax.contourf(x, y, z, NL, alpha=0.85, cmap=surface_colormap(), zorder=1)
+        self.contours = [C, CF]
+
+        self.cax.cla()
+        cb = self.fig.colorbar(CF, cax=self.cax, **self.cbar_kw)
+        apply_style([cb.ax], self.style)
+        cb.ax.tick_params(labelsize=26)
+        cb.set_label("Test Statistic", size=32)
+        self.star.set_offsets([[obj.min_age, obj.min_reddening]])
+
+        ax.set_xlim(x[0], x[-1])
+        ax.set_ylim([y[0], y[-1]])
+        ax.set_title(title or title_format(obj), **font)
+
+        file_name = fname or ("surface_" + obj.name)
+        if save:
+            save_figure(self.fig, outdir, file_name, format, bbox_inches=0)
+        return self.fig
+
+def surface_subplot(obj, ax, levels=15,
             labels=False,
             title=None,
             *args, **kwargs):
-#    mpl.rcParams = dict(mpl.rcParams, **options)
     NL = levels
     x  = obj.model.age
     y  = obj.observation.reddening
     z  = 1.0 / np.array(obj.stat)
 
-#    fig = plt.figure()
-#    border_width = 0.10
-#    border_height = 0.07
-#    ax_size = [0+border_width, 0+border_height,
-#               1-0.5*border_width, 1-2*border_height]
-#    ax = fig.add_axes(ax_size)
-
-    C  = plt.contour(x, y, z, NL, colors=['k'], linewidths=0.10)
-    if labels: plt.clabel(C, inline=1, linewidths=0.10, **small_font)
-    CF = plt.contourf(x, y, z, NL, alpha=0.85, cmap=cm.jet)
-    CF.cmap.set_under('k')
-    CF.cmap.set_over('w')
-#    cb = fig.colorbar(CF)
-#    cb.set_label("Test Statistic")
-    plt.scatter([obj.min_age], [obj.min_reddening], c='w', s=350, marker="*")
-    plt.xlim([obj.model.age[0], obj.model.age[-1]])
-    plt.ylim([obj.observation.reddening[0], obj.observation.reddening[-1]])
+    C  = ax.contour(x, y, z, NL, colors=['k'], linewidths=0.10)
+    if labels:
+        with RENDER_LOCK:
+            ax.clabel(C, inline=1, linewidths=0.10, **small_font)
+    CF = ax.contourf(x, y, z, NL, alpha=0.85, cmap=surface_colormap())
+    ax.scatter([obj.min_age], [obj.min_reddening], c='w', s=350, marker="*")
+    ax.set_xlim([x[0], x[-1]])
+    ax.set_ylim([y[0], y[-1]])
 
     if title:
-        plt.title(title, **small_font)
+        ax.set_title(title, **small_font)
     else:
-        plt.title(title_format(obj), **small_font)
+        ax.set_title(title_format(obj), **small_font)
 
-    plt.xlabel("log(Age/Year)", **small_font)
-    plt.ylabel("E (B-V)", **small_font)
-    plt.minorticks_on()
-    plt.grid(which='both')
+    ax.set_xlabel("log(Age/Year)", **small_font)
+    ax.set_ylabel("E (B-V)", **small_font)
+    ax.minorticks_on()
+    ax.grid(which='both')
 
 def scatter(obj, ages=[], reddenings=[], outdir='',
             fname='',
@@ -153,8 +293,9 @@ def scatter(obj, ages=[], reddenings=[], outdir='',
             xlabel='',
             ylabel='',
             save=False,
-            show=False,
             close=True,
+            style=None,
+            decimate=True,
             *args, **kwargs):
     model_linestyles = cycle(['--', ':', '-.', '-'])
     obsv_linestyles = cycle(['-',':','-.',':'])
@@ -169,42 +310,39 @@ def scatter(obj, ages=[], reddenings=[], outdir='',
     obsv_index = find_indices(obsv.reddening, reddenings)
     if len(obsv_index) == 0: obsv_index = [obj.min_observation]
 
+    fig = new_figure()
+    ax = fig.add_subplot(111)
+    columns = line_columns(fig, decimate)
     for mi in model_index:
         model_label = 'Model: age=%s' % (model.age[mi])
-        plt.plot(model.wavelength, model.flux[mi],
-                 label=model_label, linewidth=1.0,
-                 linestyle=next(model_linestyles))
+        ax.plot(*decimate_line(model.wavelength, model.flux[mi], columns),
+                label=model_label, linewidth=1.0,
+                linestyle=next(model_linestyles))
 
     for oi in obsv_index:
         obsv_label = 'Observation: reddening=%s' % (obsv.reddening[oi])
-        plt.plot(obsv.wavelength, obsv.flux[oi],
-                 label=obsv_label, linewidth=0.5,
-                 linestyle=next(obsv_linestyles))
+        ax.plot(*decimate_line(obsv.wavelength, obsv.flux[oi], columns),
+                label=obsv_label, linewidth=0.5,
+                linestyle=next(obsv_linestyles))
+
+    apply_style([ax], style)
+    ax.tick_params(axis='both', which='major', labelsize=16)
 
-    plt.tick_params(axis='both', which='major', labelsize=16)
-    
     if title:
-        plt.title(title, size=20)
+        ax.set_title(title, size=20)
     else:
-        plt.title('Flux vs Wavelength\n' + title_format(obj), size=20)    
-    
-    plt.xlabel("Wavelength (Angstroms)", fontsize=18)
-    plt.ylabel("Normalized Flux", fontsize=18)
-    plt.legend(loc='upper right', shadow=False, prop={'size':14})
+        ax.set_title('Flux vs Wavelength\n' + title_format(obj), size=20)
+
+    ax.set_xlabel("Wavelength (Angstroms)", fontsize=18)
+    ax.set_ylabel("Normalized Flux", fontsize=18)
+    ax.legend(loc='upper right', shadow=False, prop={'size':14})
 
     file_name = fname or ("best_spectra_match_" + obj.name)
     if save:
-        plt.savefig(
-            os.path.abspath(os.path.join(outdir, file_name)) + "." + format,
-            format=format
-        )
+        save_figure(fig, outdir, file_name, format)
+    return fig
 
-    if show:
-        plt.show()
-    if close:
-        plt.close()
-
-def scatter_subplot(obj, ages=[], reddenings=[],
+def scatter_subplot(obj, ax, ages=[], reddenings=[],
             original_ages={},
             outdir='',
             fname='',
@@ -227,28 +365,28 @@ def scatter_subplot(obj, ages=[], reddenings=[],
 
     for mi in model_index:
         model_label = 'Model: age=%s' % (model.age[mi])
-        plt.plot(model.wavelength, model.flux[mi],
-                 label=model_label, linewidth=0.13,
-                 linestyle='solid', color='b')
+        ax.plot(model.wavelength, model.flux[mi],
+                label=model_label, linewidth=0.13,
+                linestyle='solid', color='b')
 
     for oi in obsv_index:
         if obsv_name in original_ages:
             obsv_label = 'Observation: age=%s' % original_ages[obsv_name]
         else:
             obsv_label = 'Observation'
-        plt.plot(obsv.wavelength, obsv.flux[oi],
-                 label=obsv_label, linewidth=0.8, linestyle='solid', color='g')
+        ax.plot(obsv.wavelength, obsv.flux[oi],
+                label=obsv_label, linewidth=0.8, linestyle='solid', color='g')
 
-    plt.tick_params(axis='both', which='major', labelsize=20)
+    ax.tick_params(axis='both', which='major', labelsize=20)
 
     if title:
-        plt.title(title)
+        ax.set_title(title)
     else:
-        plt.title('[{}]'.format(obsv_name))
+        ax.set_title('[{}]'.format(obsv_name))
 
-    plt.xlabel(u"Wavelength (Angstroms)")
-    plt.ylabel("Normalized Flux")
-    plt.legend(loc='upper right', shadow=False, prop={'size':7})
+    ax.set_xlabel(u"Wavelength (Angstroms)")
+    ax.set_ylabel("Normalized Flux")
+    ax.legend(loc='upper right', shadow=False, prop={'size':7})
 
 def residual_match(obj, outdir='',
             fname='',
@@ -257,47 +395,48 @@ def residual_match(obj, outdir='',
             xlabel='',
             ylabel='',
             save=False,
-            show=False,
+            style=None,
+            decimate=True,
             *args, **kwargs):
-    mpl.rcParams = dict(mpl.rcParams, **options)
     model = obj.model
     obsv = obj.observation
     flux = model.flux[obj.min_model] - obsv.flux[obj.min_observation]
 
-    fig = plt.figure(figsize=(8, 6))
-    gs = mpl.gridspec.GridSpec(2, 1, height_ratios=[3, 1])
-    ax1 = plt.subplot(gs[0])
-    ax2 = plt.subplot(gs[1], sharex=ax1)
-    plt.setp(ax1.get_xticklabels(), visible=False)
-    plt.minorticks_on()
+    fig = new_figure(figsize=(8, 6))
+    columns = line_columns(fig, decimate)
+    gs = gridspec.GridSpec(2, 1, height_ratios=[3, 1])
+    ax1 = fig.add_subplot(gs[0])
+    ax2 = fig.add_subplot(gs[1], sharex=ax1)
+    apply_style([ax1, ax2], style)
+    for label in ax1.get_xticklabels():
+        label.set_visible(False)
+    ax2.minorticks_on()
 
     if title:
         ax1.set_title(title)
     else:
         ax1.set_title('Normalized Flux vs Wavelength\n' + title_format(obj))
 
-    ax1.plot(model.wavelength, model.flux[obj.min_model], label="Model", linewidth=0.6)
-    ax1.plot(obsv.wavelength, obsv.flux[obj.min_observation], label="Observation", linewidth=0.9)
+    ax1.plot(*decimate_line(model.wavelength, model.flux[obj.min_model], columns),
+             label="Model", linewidth=0.6)
+    ax1.plot(*decimate_line(obsv.wavelength, obsv.flux[obj.min_observation], columns),
+             label="Observation", linewidth=0.9)
     ax1.set_ylabel('Normalized Flux', fontsize=18)
     ax1.legend(loc='lower right', shadow=False, prop={'size':10})
 
     ax2.axhline(0, color='black', linewidth=1)
     ax2.set_xlim(obsv.wavelength[0], obsv.wavelength[-1])
-    ax2.plot(obsv.wavelength, flux, color='r', label="Residual Flux", linewidth=0.7)
+    ax2.plot(*decimate_line(obsv.wavelength, flux, columns),
+             color='r', label="Residual Flux", linewidth=0.7)
     ax2.set_xlabel("Wavelength (Angstroms)", fontsize=18)
     ax2.legend(loc='best', shadow=False, prop={'size':10})
 
-    plt.tight_layout()
+    with RENDER_LOCK:
+        fig.tight_layout()
     file_name = fname or ("residual_match_" + obj.name)
     if save:
-        plt.savefig(
-            os.path.abspath(os.path.join(outdir, file_name)) + "." + format,
-            format=format
-        )
-
-    if show:
-        plt.show()
-    plt.close()
+        save_figure(fig, outdir, file_name, format)
+    return fig
 
 def residual(obj, outdir='',
             fname='',
@@ -306,16 +445,22 @@ def residual(obj, outdir='',
             xlabel='',
             ylabel='',
             save=False,
-            show=False,
+            style=None,
+            decimate=True,
             *args, **kwargs):
     model = obj.model
     obsv = obj.observation
     flux = model.flux[obj.min_model] - obsv.flux[obj.min_observation]
-    f, (ax1, ax2, ax3, ax4) = plt.subplots(4, sharex=True, sharey=True)
+    fig = new_figure()
+    (ax1, ax2, ax3, ax4) = stacked_axes(fig, 4)
+    apply_style([ax1, ax2, ax3, ax4], style)
+    columns = line_columns(fig, decimate)
+    model_line = decimate_line(model.wavelength, model.flux[obj.min_model], columns)
+    obsv_line = decimate_line(
+        obsv.wavelength, obsv.flux[obj.min_observation], columns)
+
+    ax1.plot(*model_line, label="Model Flux", linewidth=0.5)
 
-    ax1.plot(model.wavelength, model.flux[obj.min_model],
-             label="Model Flux", linewidth=0.5)
-    
     if title:
         ax1.set_title(title)
     else:
@@ -323,19 +468,19 @@ def residual(obj, outdir='',
     ax1.tick_params(which='major', labelsize=8)
     ax1.legend(loc='upper right', shadow=False, prop={'size':7})
 
-    ax2.plot(obsv.wavelength, obsv.flux[obj.min_observation],
-             label="Observation Flux", linewidth=0.5)
+    ax2.plot(*obsv_line, label="Observation Flux", linewidth=0.5)
     ax2.set_ylabel("Normalized Flux")
     ax2.legend(loc='upper right', shadow=False, prop={'size':7})
     ax2.tick_params(which='major', labelsize=8)
 
-    ax3.plot(model.wavelength, model.flux[obj.min_model], linewidth=0.5)
-    ax3.plot(obsv.wavelength, obsv.flux[obj.min_observation], linewidth=0.5)
+    ax3.plot(*model_line, linewidth=0.5)
+    ax3.plot(*obsv_line, linewidth=0.5)
     ax3.tick_params(which='major', labelsize=8)
 
     ax4.axhline(0, color='black', linewidth=1)
     ax4.set_xlim(obsv.wavelength[0], obsv.wavelength[-1])
-    ax4.plot(obsv.wavelength, flux, label="Residual Flux", linewidth=0.5)
+    ax4.plot(*decimate_line(obsv.wavelength, flux, columns),
+             label="Residual Flux", linewidth=0.5)
     ax4.set_xlabel("Wavelength (Angstroms)")
 
     ax4.legend(loc='upper right', shadow=False, prop={'size':7})
@@ -343,14 +488,8 @@ def residual(obj, outdir='',
 
     file_name = fname or ("residual_" + obj.name)
     if save:
-        plt.savefig(
-            os.path.abspath(os.path.join(outdir, file_name)) + "." + format,
-            format=format
-        )
-
-    if show:
-        plt.show()
-    plt.close()
+        save_figure(fig, outdir, file_name, format)
+    return fig
 
 def surface_error(obj, levels=15, outdir='',
             fname='',
@@ -360,52 +499,46 @@ def surface_error(obj, levels=15, outdir='',
             xlabel='',
             ylabel='',
             save=False,
-            show=False,
+            style=None,
             *args, **kwargs):
-    mpl.rcParams = dict(mpl.rcParams, **options)
     NL = levels
     x  = obj.model.age
     y  = obj.observation.reddening
     z  = 1.0 / np.array(obj.stat)
 
-    fig = plt.figure(figsize=(16,10))
+    fig = new_figure(figsize=(16,10))
     border_width = 0.10
     border_height = 0.07
     ax_size = [0+border_width, 0+border_height,
                1-0.5*border_width, 1-2*border_height]
     ax = fig.add_axes(ax_size)
 
-    C  = plt.contour(x, y, z, NL, colors=['k'], linewidths=0.10)
-    if labels: plt.clabel(C, inline=1, linewidths=0.10, **small_font)
-    CF = plt.contourf(x, y, z, NL, alpha=0.85, cmap=cm.jet)
-    CF.cmap.set_under('k')
-    CF.cmap.set_over('w')
-    cb = fig.colorbar(CF)
+    C  = ax.contour(x, y, z, NL, colors=['k'], linewidths=0.10)
+    if labels:
+        with RENDER_LOCK:
+            ax.clabel(C, inline=1, linewidths=0.10, **small_font)
+    CF = ax.contourf(x, y, z, NL, alpha=0.85, cmap=surface_colormap())
+    cb = fig.colorbar(CF, ax=ax)
+    apply_style([ax, cb.ax], style)
     cb.set_label("Inverse Chi-Squared Statistic")
-    plt.scatter([obj.min_age], [obj.min_reddening], c='w', s=350, marker="*")
+    ax.scatter([obj.min_age], [obj.min_reddening], c='w', s=350, marker="*")
     for error_age, error_reddening, error_stat in zip(obj.error_age, obj.error_reddening, obj.error_stat):
-        plt.plot([error_age], [error_reddening], 'ro')
+        ax.plot([error_age], [error_reddening], 'ro')
 
-    plt.xlim([obj.model.age[0], obj.model.age[-1]])
-    plt.ylim([obj.observation.reddening[0], obj.observation.reddening[-1]])
+    ax.set_xlim([x[0], x[-1]])
+    ax.set_ylim([y[0], y[-1]])
 
-    plt.title(title_format(obj), **font)
-    plt.xlabel("log(Age/Year)", **font)
-    plt.ylabel("E (B-V)", **font)
+    ax.set_title(title_format(obj), **font)
+    ax.set_xlabel("log(Age/Year)", **font)
+    ax.set_ylabel("E (B-V)", **font)
 
-    plt.minorticks_on()
-    plt.grid(which='both')
+    ax.minorticks_on()
+    ax.grid(which='both')
 
     file_name = fname or ("surface_error_" + obj.name)
     if save:
-        plt.savefig(
-            os.path.abspath(os.path.join(outdir, file_name)) + "." + format,
-            bbox_inches=0
-        )
-
-    if show:
-        plt.show()
-    plt.close()
+        save_figure(fig, outdir, file_name, format, bbox_inches=0)
+    return fig
 
 def tile_plot(tile_subplot, objs, nrows, ncols, outdir='',
             fname='',
@@ -414,37 +547,168 @@ def tile_plot(tile_subplot, objs, nrows, ncols, outdir='',
             xlabel='',
             ylabel='',
             save=False,
-            show=False,
             *args, **kwargs):
-    fig, axes = plt.subplots(nrows, ncols, figsize=(11.312,16))
-    fig.tight_layout()
-    obj_index = 1
-    for i in range(1, nrows+1):
-        for j in range(1, ncols+1):
-            plt.subplot(nrows, ncols, obj_index)
-            if obj_index <= len(objs):
-                tile_subplot(objs[obj_index-1])
-            else:
-                plt.plot()
-                plt.axis("off")
-            obj_index += 1
+    fig = new_figure(figsize=(11.312,16))
+    axes = [fig.add_subplot(nrows, ncols, i + 1) for i in range(nrows * ncols)]
+    with RENDER_LOCK:
+        fig.tight_layout()
+    for (obj_index, ax) in enumerate(axes):
+        if obj_index < len(objs):
+            tile_subplot(objs[obj_index], ax)
+        else:
+            ax.plot()
+            ax.axis("off")
 
-    plt.subplots_adjust(hspace = 0.32, wspace=0.3)
+    fig.subplots_adjust(hspace = 0.32, wspace=0.3)
     file_name = fname or 'surface_tile'
 
     if save:
-        plt.savefig(
-            os.path.abspath(os.path.join(outdir, file_name)) + "." + format,
-            format=format,
+        save_figure(fig, outdir, file_name, format,
             bbox_inches='tight',
             orientation='portrait',
             papertype='a4',
             dpi=800
         )
-    plt.close()
+    return fig
 
 def surface_tile(*args, **kwargs):
-    tile_plot(surface_subplot, *args, **kwargs)
+    return tile_plot(surface_subplot, *args, **kwargs)
+
+class PlotBase(object):
+    "The parts of a model or observation the per-object plots read"
+
+    def __init__(self, base, rows=()):
+        rows = sorted(set(int(i) for i in rows))
+        self.original_name = base.original_name
+        self.wavelength = base.wavelength
+        self.var = base.var
+        # Only the drawn rows, under their index in the full flux
+        flux = base.rows(rows) if hasattr(base, 'rows') else base.flux[rows]
+        self.flux = dict(zip(rows, flux))
+
+    @property
+    def age(self):
+        return self.var
+
+    @property
+    def reddening(self):
+        return self.var
+
+class PlotData(object):
+    """The arrays a per-object plot reads from an Asad, and nothing else.
+
+    Sent to plot worker processes instead of the object: the age and
+    reddening axes, the statistic matrix if the plot draws it and the
+    best-fit flux rows.
+    """
+
+    def __init__(self, obj, stat=False, model_rows=(), observation_rows=()):
+        self.name = obj.name
+        self.stat = obj.stat if stat else None
+        self.min_model = obj.min_model
+        self.min_observation = obj.min_observation
+        self.min_age = obj.min_age
+        self.min_reddening = obj.min_reddening
+        self.model = PlotBase(obj.model, list(model_rows) + [obj.min_model])
+        self.observation = PlotBase(
+            obj.observation, list(observation_rows) + [obj.min_observation])
+
+    @staticmethod
+    def for_plot(kind, obj, ages=[], reddenings=[], **kwargs):
+        "PlotData holding what the plot function named kind draws of obj"
+        if kind == 'surface':
+            return PlotData(obj, stat=True)
+        if kind == 'scatter':
+            return PlotData(
+                obj,
+                model_rows=np.searchsorted(obj.model.age, ages),
+                observation_rows=np.searchsorted(obj.observation.reddening,
+                                                 reddenings))
+        return PlotData(obj)
+
+PLOTS = {
+    'surface'        : surface,
+    'scatter'        : scatter,
+    'residual_match' : residual_match,
+    'residual'       : residual,
+}
+
+def render(task):
+    "Process pool worker: draws one (kind, PlotData, kwargs) figure"
+    (kind, data, kwargs) = task
+    try:
+        PLOTS[kind](data, **kwargs)
+        return None
+    except Exception as err:
+        return unicode(err)
+
+# Bundle file names, the prefixes of the single figure files
+BUNDLE_NAMES = {
+    'surface'        : 'surface',
+    'scatter'        : 'best_spectra_match',
+    'residual_match' : 'residual_match',
+    'residual'       : 'residual',
+}
+
+class PdfBundle(object):
+    """All figures of a kind as the pages of one PDF, instead of a file each.
+
+    Pages are written as they are added, figures are not kept. Closing
+    appends the index pages: the page, name and format_chosen values of
+    every object, so it also covers objects added while streaming.
+    """
+    INDEX_ENTRIES = 30
+    INDEX_FIGSIZE = (8.27, 11.69)
+    INDEX_FONT = {
+        'family'   : 'monospace',
+        'fontsize' : 7
+    }
+
+    def __init__(self, path, title=''):
+        self._path = path
+        self._title = title
+        self._entries = []
+        self._pages = PdfPages(path)
+        self._pages.infodict()['Title'] = title
+
+    def add(self, obj, fig):
+        with RENDER_LOCK:
+            self._pages.savefig(fig)
+        self._entries.append((self._pages.get_pagecount(), obj.format_chosen()))
+
+    def index_figure(self, entries):
+        fig = new_figure(figsize=self.INDEX_FIGSIZE)
+        lines = ['{:>5}  {}'.format('Page', 'Name, Age, Reddening'), '']
+        for (page, chosen) in entries:
+            for (i, line) in enumerate(chosen.rstrip('\n').split('\n')):
+                lines.append('{:>5}  {}'.format(page if i == 0 else '', line))
+        fig.text(0.05, 0.97, '{} index'.format(self.title),
+                 fontname='Sans', fontsize=12, va='top')
+        fig.text(0.05, 0.94, '\n'.join(lines), va='top', **self.INDEX_FONT)
+        return fig
+
+    def close(self):
+        for start in range(0, max(len(self._entries), 1), self.INDEX_ENTRIES):
+            fig = self.index_figure(self._entries[start:start + self.INDEX_ENTRIES])
+            with RENDER_LOCK:
+                self._pages.savefig(fig)
+        self._pages.close()
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def title(self):
+        return self._title
+
+    @property
+    def num(self):
+        return len(self._entries)
+
+    @property
+    def entries(self):
+        return list(self._entries)
 
 """
 def scatter_tile(objs, nrows, ncols, original_ages=None, outdir='',
@@ -1,129 +1,579 @@
 from __future__ import print_function
-import copy, io, math, os, os.path, uuid
+import collections, copy, hashlib, io, math, os, os.path, uuid
 import numpy as np
 from pprint import pprint
 from functools import reduce
 
+from cache import TextCache
+
 #===============================================================================
 
 class Math(object):
 
     @staticmethod
-    def wavelength_interpolate_step(xs, interp=3, step=0.3):
-        if interp == step:
-            return xs
+    def window_starts(num, sample_step):
+        "First index of every smoothing window, truncated like a float index"
+        return (np.arange(num) * sample_step).astype(int)
+
+    @staticmethod
+    def boxcar(xss, starts, nsample, out=None):
+        """Mean of xss[..., s:s+nsample] for every s in starts.
+
+        One cumulative sum along the last axis gives every window sum as
+        a difference, so a whole flux stack is smoothed in a single pass.
+        With out, which may be a view into xss, rows are smoothed one at a
+        time and written there, only one row is ever held twice.
+        """
+        xss = np.asarray(xss, dtype=float)
+        if len(starts) and starts[-1] + nsample > xss.shape[-1]:
+            raise IndexError('window {}:{} out of bounds for {} samples'.format(
+                starts[-1], starts[-1] + nsample, xss.shape[-1]))
+        if out is not None:
+            if xss.ndim == 1:
+                out[...] = Math.boxcar(xss, starts, nsample)
+            for i in range(len(xss) if xss.ndim > 1 else 0):
+                out[i] = Math.boxcar(xss[i], starts, nsample)
+            return out
+        cs = np.zeros(xss.shape[:-1] + (xss.shape[-1] + 1,))
+        np.cumsum(xss, axis=-1, out=cs[..., 1:])
+        return (cs[..., starts + nsample] - cs[..., starts]) / nsample
+
+    @staticmethod
+    def smoothing_windows(num, interp, step, obsv=False):
+        """(starts, nsample) of the windows averaged when smoothing num samples.
 
+        The _obsv variants keep their first sample, windows start after it.
+        """
         sample_step = interp / step
         nsample     = int(2*sample_step - 1)
-        result_num  = int((len(xs)/sample_step) - 1)
-        result      = np.zeros([result_num])
+        if obsv:
+            result_num = int((num/sample_step) - 3)
+            return (Math.window_starts(result_num, sample_step) + 1, nsample)
+        result_num = int((num/sample_step) - 1)
+        return (Math.window_starts(result_num, sample_step), nsample)
 
-        for i in range(result_num):
-            tot = 0
-            for k in range(nsample):
-                tot += xs[i*sample_step + k]
-            result[i] = tot / nsample
+    @staticmethod
+    def wavelength_interpolate_step(xs, interp=3, step=0.3):
+        if interp == step:
+            return xs
 
-        return result
+        (starts, nsample) = Math.smoothing_windows(len(xs), interp, step)
+        return Math.boxcar(xs, starts, nsample)
 
     @staticmethod
     def wavelength_interpolate_step_obsv(xs, interp=3, step=0.3):
         if interp == step:
             return xs
 
-        sample_step = interp / step
-        nsample     = int(2*sample_step - 1)
-        result_num  = int((len(xs)/sample_step) - 3)
-        result      = np.zeros([result_num])
-        xs2         = xs[1:]
-
-        for i in range(result_num):
-            tot = 0
-            for k in range(nsample):
-                tot += xs2[i*sample_step + k]
-            result[i] = tot / nsample
-
-        return np.append(np.array([xs[0]]), result)
+        (starts, nsample) = Math.smoothing_windows(len(xs), interp, step, True)
+        return np.append(np.array([xs[0]]), Math.boxcar(xs, starts, nsample))
 
     @staticmethod
-    def flux_interpolate_step(xss, interp, step):
+    def flux_interpolate_step(xss, interp, step, inplace=False):
         if interp == step:
             return xss
 
-        sample_step  = interp / step
-        nsample      = int(2*sample_step - 1)
-        result_nrows = xss.shape[0]
-        result_ncols = int((xss.shape[1] / sample_step) - 1)
-        result       = np.zeros([result_nrows, result_ncols])
-
-        for i in range(result_nrows):
-            row = xss[i]
-            for j in range(result_ncols):
-                tot = 0
-                num = j * sample_step
-                sample = row[num:num+nsample]
-                for k in range(nsample):
-                    tot += sample[k]
-                result[i, j] = tot / nsample
-
-        return result
+        (starts, nsample) = Math.smoothing_windows(xss.shape[1], interp, step)
+        out = xss[:, :len(starts)] if inplace else None
+        return Math.boxcar(xss, starts, nsample, out=out)
 
     @staticmethod
-    def flux_interpolate_step_obsv(xss, interp, step):
+    def flux_interpolate_step_obsv(xss, interp, step, inplace=False):
         if interp == step:
             return xss
 
-        sample_step     = interp / step
-        nsample         = int(2*sample_step - 1)
-        result_ncols    = int((xss.shape[1] / sample_step) - 3)
-        result          = np.zeros([result_ncols])
-        row             = xss[0]
-        first, row_rest = row[0], row[1:]
-
-        for i in range(result_ncols):
-            tot = 0
-            num = i * sample_step
-            sample = row_rest[num:num+nsample]
-            for k in range(nsample):
-                tot += sample[k]
-            result[i] = tot / nsample
-
-        result = np.append(np.array([first]), result)
-        return np.array([result])
+        (starts, nsample) = Math.smoothing_windows(
+            xss.shape[1], interp, step, True)
+        # The first sample is kept as is, windows start after it
+        if inplace:
+            Math.boxcar(xss, starts, nsample, out=xss[:, 1:len(starts)+1])
+            return xss[:, :len(starts)+1]
+        return np.hstack([xss[:, :1], Math.boxcar(xss, starts, nsample)])
 
 #===============================================================================
 
 class Statistics(object):
 
-    STAT_TEST_NAMES = ['chi-squared', 'ks']
+    STAT_TEST_NAMES    = ['chi-squared', 'ks']
+    KS_CHUNK_BYTES     = 64 * 2**20
+    FUSED_BLOCK_BYTES  = 256 * 2**10
+    ACCUMULATE_COLUMNS = 256
 
     @staticmethod
     def ks_2_sample_freq_test(xs, ys):
-        csx = np.cumsum(xs)
-        csy = np.cumsum(ys)
+        csx = np.cumsum(xs, dtype=np.float64)
+        csy = np.cumsum(ys, dtype=np.float64)
         cpx = csx / float(csx[-1])
         cpy = csy / float(csy[-1])
         return np.max(np.abs(cpx - cpy))
 
+    @staticmethod
+    def cdf(xss):
+        "Normalized cumulative distribution of every row of xss, summed in double"
+        cs = np.cumsum(xss, axis=1, dtype=np.float64)
+        cs /= cs[:, -1:]
+        return cs.astype(xss.dtype, copy=False)
+
+    @staticmethod
+    def ks_2_sample_matrix(xss, yss, chunk_size=None):
+        """KS statistic of every row of xss against every row of yss.
+
+        Each CDF is built once, the max-abs-difference is then taken over
+        chunks of xss rows so the broadcast stays under KS_CHUNK_BYTES.
+        """
+        return Statistics.ks_2_sample_operands_matrix(
+            Statistics.ks_2_sample_operands(xss),
+            Statistics.ks_2_sample_operands(yss), chunk_size)
+
+    @staticmethod
+    def ks_2_sample_operands(xss):
+        return (Statistics.cdf(xss),)
+
+    @staticmethod
+    def ks_2_sample_operands_matrix(xs, ys, chunk_size=None):
+        "ks_2_sample_matrix of the ks_2_sample_operands of both sides"
+        (cdf_x, cdf_y) = (xs[0], ys[0])
+        if chunk_size is None:
+            row_bytes = cdf_y.size * cdf_y.itemsize
+            chunk_size = max(1, Statistics.KS_CHUNK_BYTES // row_bytes)
+        stat = np.empty([cdf_x.shape[0], cdf_y.shape[0]])
+        for i in range(0, cdf_x.shape[0], chunk_size):
+            diff = cdf_x[i:i+chunk_size, np.newaxis, :] - cdf_y[np.newaxis]
+            stat[i:i+chunk_size] = np.max(np.abs(diff), axis=2)
+        return stat
+
     @staticmethod
     def chi_squared_freq_test(xs, ys):
-        return np.sum((xs - ys) ** 2)
+        return np.sum((xs - ys) ** 2, dtype=np.float64)
+
+    @staticmethod
+    def product(xss, yss):
+        """xss . yss^T in double precision.
+
+        Single precision operands are converted ACCUMULATE_COLUMNS columns
+        at a time and multiplied in double precision. A float32 product
+        would carry its rounding error into chi_squared_matrix, where the
+        norms cancel it into the statistic.
+        """
+        if np.result_type(xss, yss) == np.float64:
+            return np.dot(xss, yss.T)
+        stat = np.zeros([xss.shape[0], yss.shape[0]])
+        for j in range(0, xss.shape[1], Statistics.ACCUMULATE_COLUMNS):
+            cols = slice(j, j + Statistics.ACCUMULATE_COLUMNS)
+            stat += np.dot(xss[:, cols].astype(np.float64),
+                           yss[:, cols].astype(np.float64).T)
+        return stat
+
+    @staticmethod
+    def square_norms(xss):
+        "Squared norm of every row of xss, squared and summed in double"
+        if xss.dtype == np.float64:
+            return np.sum(xss ** 2, axis=1)
+        return np.einsum('ij,ij->i', xss, xss, dtype=np.float64)
+
+    @staticmethod
+    def chi_squared_matrix(xss, yss):
+        """Chi-squared of every row of xss against every row of yss.
+
+        Uses ||x||^2 + ||y||^2 - 2*X.Y^T so the whole matrix is a single
+        BLAS product instead of one Python call per (x, y) pair.
+        """
+        return Statistics.chi_squared_operands_matrix(
+            Statistics.chi_squared_operands(xss),
+            Statistics.chi_squared_operands(yss))
+
+    @staticmethod
+    def chi_squared_operands(xss):
+        return (xss, Statistics.square_norms(xss))
+
+    @staticmethod
+    def chi_squared_operands_matrix(xs, ys):
+        "chi_squared_matrix of the chi_squared_operands of both sides"
+        ((xss, xx), (yss, yy)) = (xs, ys)
+        stat = Statistics.product(xss, yss)
+        stat *= -2
+        stat += xx[:, np.newaxis]
+        stat += yy[np.newaxis, :]
+        # Cancellation can leave tiny negative values for identical rows
+        return np.maximum(stat, 0, out=stat)
+
+    @staticmethod
+    def tile_bytes(stat_test, num_x, num_y, num_wl, itemsize=8):
+        "Estimated peak temporary memory of one matrix_test call"
+        operands = (num_x + num_y) * num_wl
+        if stat_test is Statistics.ks_2_sample_freq_test:
+            # Both CDFs plus the broadcast difference and its absolute value
+            return itemsize * (operands + 2 * num_x * num_y * num_wl)
+        # Squares of both operands plus the product matrix
+        return itemsize * (operands + num_x * num_y)
+
+    @staticmethod
+    def operand_bytes(stat_test, num, num_wl, itemsize=8):
+        "Memory of the operands of num rows, kept for a whole tiled_matrix"
+        if stat_test is Statistics.ks_2_sample_freq_test:
+            return itemsize * num * num_wl
+        return 8 * num
+
+    @staticmethod
+    def tile_size(stat_test, num_x, num_y, num_wl, max_memory_mb, itemsize=8):
+        """Largest (rows_x, rows_y) block that fits in max_memory_mb.
+
+        The operands of all of y, built once for every tile, are taken off
+        the budget first. Rows of x are halved first so a tile keeps
+        spanning the whole y range as long as possible, (1, 1) is returned
+        if nothing fits.
+        """
+        budget = max_memory_mb * 2**20 - Statistics.operand_bytes(
+            stat_test, num_y, num_wl, itemsize)
+        (tile_x, tile_y) = (num_x, num_y)
+        fits = lambda: Statistics.tile_bytes(
+            stat_test, tile_x, tile_y, num_wl, itemsize) <= budget
+        while tile_x > 1 and not fits():
+            tile_x = (tile_x + 1) // 2
+        while tile_y > 1 and not fits():
+            tile_y = (tile_y + 1) // 2
+        return (tile_x, tile_y)
+
+    @staticmethod
+    def rows(operands, start, end):
+        return tuple(array[start:end] for array in operands)
+
+    @staticmethod
+    def tiled_matrix(stat_test, xss, yss, max_memory_mb):
+        """matrix_test evaluated block by block, returns (stat, tile_size).
+
+        The operands (CDFs or norms) of yss are built once and those of a
+        block of xss once per block row, tiles only slice them.
+        """
+        (operands, operands_matrix) = Statistics.operands_test(stat_test)
+        (num_x, num_y) = (xss.shape[0], yss.shape[0])
+        (tile_x, tile_y) = Statistics.tile_size(
+            stat_test, num_x, num_y, xss.shape[1], max_memory_mb, xss.itemsize)
+        ys = operands(yss)
+        stat = np.empty([num_x, num_y])
+        for i in range(0, num_x, tile_x):
+            xs = operands(xss[i:i+tile_x])
+            for j in range(0, num_y, tile_y):
+                stat[i:i+tile_x, j:j+tile_y] = operands_matrix(
+                    xs, Statistics.rows(ys, j, j+tile_y))
+        return (stat, (tile_x, tile_y))
+
+    @staticmethod
+    def fused_matrix(stat_test, flux, base, reddening, normalize, yss):
+        """Statistic of every reddening of flux against every row of yss.
+
+        Reddening, normalization and comparison run together over blocks
+        of FUSED_BLOCK_BYTES, the reddened observation is never built, so
+        peak memory stays about the size of yss. normalize(xss, reddening)
+        scales the rows of a block, see Observation.apply_normalization.
+        The operands (CDFs or norms) of yss are built once for all blocks.
+        """
+        (operands, operands_matrix) = Statistics.operands_test(stat_test)
+        ys = operands(yss)
+        block = max(1, Statistics.FUSED_BLOCK_BYTES // flux.nbytes)
+        stat = np.empty([len(reddening), yss.shape[0]])
+        for i in range(0, len(reddening), block):
+            xss = Observation.redden(flux, base, reddening[i:i+block])
+            stat[i:i+block] = operands_matrix(
+                operands(normalize(xss, reddening[i:i+block])), ys)
+        return stat
+
+    @staticmethod
+    def loop_matrix(stat_test, xss, yss):
+        "Reference matrix, one stat_test call per (x, y) pair"
+        stat = np.zeros([xss.shape[0], yss.shape[0]])
+        for i in range(xss.shape[0]):
+            for j in range(yss.shape[0]):
+                stat[i,j] = stat_test(xss[i], yss[j])
+        return stat
+
+    @staticmethod
+    def paired_matrix(stat_test, xss, yss):
+        "stat_test of row i of xss against row i of yss, for every i"
+        if stat_test is Statistics.chi_squared_freq_test:
+            return np.sum((xss - yss) ** 2, axis=1, dtype=np.float64)
+        if stat_test is Statistics.ks_2_sample_freq_test:
+            return np.max(np.abs(
+                Statistics.cdf(xss) - Statistics.cdf(yss)), axis=1)
+        return np.array([stat_test(xs, ys) for (xs, ys) in zip(xss, yss)])
+
+    @staticmethod
+    def stat_tests():
+        return dict(zip(Statistics.STAT_TEST_NAMES, [
+            Statistics.chi_squared_freq_test,
+            Statistics.ks_2_sample_freq_test,
+        ]))
+
+    @staticmethod
+    def stat_test_name(stat_test):
+        "Name of a known stat test, functions on a class do not pickle"
+        for (name, test) in Statistics.stat_tests().items():
+            if test is stat_test:
+                return name
+        raise ValueError('Unknown stat test: {}'.format(stat_test))
+
+    @staticmethod
+    def operands_test(stat_test):
+        """(operands, operands_matrix) of a test, operands_matrix(operands(xss),
+        operands(yss)) is its matrix; the loop_matrix for other tests"""
+        return {
+            Statistics.chi_squared_freq_test : (
+                Statistics.chi_squared_operands,
+                Statistics.chi_squared_operands_matrix),
+            Statistics.ks_2_sample_freq_test : (
+                Statistics.ks_2_sample_operands,
+                Statistics.ks_2_sample_operands_matrix),
+        }.get(stat_test, (
+            lambda xss: (xss,),
+            lambda xs, ys: Statistics.loop_matrix(stat_test, xs[0], ys[0])))
+
+    @staticmethod
+    def matrix_test(stat_test):
+        "Batched counterpart of a pairwise test, None if there is none"
+        return {
+            Statistics.chi_squared_freq_test : Statistics.chi_squared_matrix,
+            Statistics.ks_2_sample_freq_test : Statistics.ks_2_sample_matrix,
+        }.get(stat_test)
+
+#===============================================================================
+
+class Plan(object):
+    """Flux operations recorded by a lazy Base, run together on first read.
+
+    Steps are tuples: ('index', start, end) keeps columns start:end,
+    ('smooth', starts, nsample, keep_first) averages the windows given by
+    Math.smoothing_windows, ('normalize', index) and ('average',) scale
+    every row. Consecutive index and smooth steps are fused: only the
+    source columns the last of them needs are read, and a range cut made
+    after smoothing only smooths the windows that survive it.
+    """
+    COLUMN_STEPS = ('index', 'smooth')
+
+    @staticmethod
+    def run(flux, steps):
+        i = 0
+        while i < len(steps):
+            j = i
+            while j < len(steps) and steps[j][0] in Plan.COLUMN_STEPS:
+                j += 1
+            if j > i:
+                flux = Plan.run_columns(flux, steps[i:j])
+                i = j
+            else:
+                flux = Plan.run_rows(flux, steps[i])
+                i += 1
+        return flux
+
+    @staticmethod
+    def windows(step):
+        "(starts, lengths) of the input columns averaged into each output column"
+        (kind, starts, nsample, keep_first) = step
+        lengths = np.repeat(nsample, len(starts))
+        if keep_first:
+            return (np.append(0, starts), np.append(1, lengths))
+        return (starts, lengths)
+
+    @staticmethod
+    def width(step):
+        if step[0] == 'index':
+            return step[2] - step[1]
+        return len(step[1]) + int(step[3])
+
+    @staticmethod
+    def run_columns(flux, steps):
+        # Walk back from the columns the last step outputs to the source
+        # columns, recording which output columns every step must produce
+        (lo, hi) = (0, Plan.width(steps[-1]))
+        needs = []
+        for step in reversed(steps):
+            needs.append((lo, hi))
+            if step[0] == 'index':
+                (lo, hi) = (lo + step[1], hi + step[1])
+            elif hi > lo:
+                (starts, lengths) = Plan.windows(step)
+                (lo, hi) = (starts[lo:hi].min(),
+                            (starts[lo:hi] + lengths[lo:hi]).max())
+        needs.reverse()
+
+        # Column k of flux is input column offset + k of the current step
+        (flux, offset) = (flux[..., lo:hi], lo)
+        for (step, (lo, hi)) in zip(steps, needs):
+            if step[0] == 'index':
+                offset -= step[1]
+                flux = flux[..., lo - offset:hi - offset]
+            else:
+                (starts, lengths) = Plan.windows(step)
+                flux = Plan.smooth(flux, starts[lo:hi] - offset, lengths[lo:hi])
+            offset = lo
+        return flux
+
+    @staticmethod
+    def smooth(flux, starts, lengths):
+        if len(lengths) > 1 and lengths[0] != lengths[1]:
+            # The sample kept by the _obsv smoothing
+            return np.concatenate(
+                [flux[..., starts[0]:starts[0]+1],
+                 Math.boxcar(flux, starts[1:], lengths[1])], axis=-1)
+        return Math.boxcar(flux, starts, lengths[0] if len(lengths) else 1)
+
+    @staticmethod
+    def run_rows(flux, step):
+        if step[0] == 'normalize':
+            return Base.normalized_flux(flux, step[1])
+        return Base.average_normalized_flux(flux)
 
 #===============================================================================
 
-class Base(object):
+class Compact(object):
+    """Attributes kept in __slots__ instead of a per-instance __dict__.
+
+    Survey runs hold tens of thousands of objects, slots make each of
+    them smaller and attribute reads cheaper. Subclasses list their own
+    slots, the state of an object is every slot that is set.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def slot_names(cls):
+        return [name for klass in cls.__mro__
+                for name in getattr(klass, '__slots__', ())]
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name))
+                    for name in self.slot_names() if hasattr(self, name))
+
+    def __setstate__(self, state):
+        for (name, value) in state.items():
+            setattr(self, name, value)
+
+#===============================================================================
+
+class Base(Compact):
+
+    SHARED_ARRAYS = ['_wavelength', '_flux']
 
-    def __init__(self, path=None, name=None):
+    __slots__ = ('_name', '_original_name', '_wavelength_step', '_wavelength',
+                 '_flux', '_var', '_var_start', '_var_step', '_var_axis',
+                 '_normalization', '_shared', '_plan', '_owns_flux')
+
+    def __init__(self, path=None, name=None, wavelength_range=None):
         self._name            = name
         self._original_name   = name
         self._wavelength_step = 0
         self._wavelength      = np.array([])
         self._flux            = np.array([])
         self._var             = None
+        self._var_axis        = None
         self._var_start       = 0
         self._var_step        = 0
+        self._normalization   = None
+        self._shared          = {}
+        self._plan            = None
+        self._owns_flux       = False
         if path:
-            self.read_from_path(path)
+            self.read_from_path(path, wavelength_range=wavelength_range)
+
+    def share(self, store):
+        """Pickle wavelength and flux as handles into a shared.SharedStore.
+
+        The arrays themselves are left untouched, an unpickled copy maps
+        the stored file read-only instead of receiving the data.
+        """
+        self.flux
+        for name in Base.SHARED_ARRAYS:
+            array = getattr(self, name)
+            if array is not None and not self.is_shared(name):
+                self._shared[name] = (store.share(array), array)
+
+    def unshare(self, store=None):
+        "Pickle the arrays themselves again, releasing their files in store"
+        if store is not None:
+            for (handle, array) in self._shared.values():
+                store.release(handle)
+        self._shared = {}
+
+    def is_shared(self, name):
+        return name in self._shared and \
+            self._shared[name][1] is getattr(self, name)
+
+    def __getstate__(self):
+        state = Compact.__getstate__(self)
+        # Ownership is of this object's array, not part of its value
+        state.pop('_owns_flux', None)
+        state['_shared'] = {}
+        for (name, (handle, array)) in self._shared.items():
+            if state[name] is array:
+                state[name] = None
+                state['_shared'][name] = handle
+        return state
+
+    def __setstate__(self, state):
+        shared = state.pop('_shared', {})
+        self._owns_flux = False
+        Compact.__setstate__(self, state)
+        self._shared = {}
+        for (name, handle) in shared.items():
+            array = handle.attach()
+            setattr(self, name, array)
+            self._shared[name] = (handle, array)
+
+    def __copy__(self):
+        result = self.__class__.__new__(self.__class__)
+        Compact.__setstate__(result, Compact.__getstate__(self))
+        result._shared = dict(self._shared)
+        # Both now hold the same flux, neither may modify it in place
+        self._owns_flux = result._owns_flux = False
+        return result
+
+    def __deepcopy__(self, memo):
+        result = self.__class__.__new__(self.__class__)
+        memo[id(self)] = result
+        for (name, value) in Compact.__getstate__(self).items():
+            setattr(result, name, copy.deepcopy(value, memo))
+        result._shared = {}
+        result._owns_flux = True
+        return result
+
+    def update(self, inplace=False, **attributes):
+        "transform, or set the attributes on self itself when inplace"
+        if not inplace:
+            return self.transform(**attributes)
+        for (name, value) in attributes.items():
+            setattr(self, name, value)
+        return self
+
+    def writable_flux(self):
+        """flux, ready to be modified in place.
+
+        Unless self owns its flux, it is copied first: the array may be
+        read-only (memory-mapped), or shared with the object it was
+        transformed from or copied to. A stale shared handle is dropped.
+        """
+        flux = self.flux
+        if not self._owns_flux or not flux.flags.writeable:
+            flux = np.array(flux)
+        self.flux = flux
+        self._owns_flux = True
+        self._shared.pop('_flux', None)
+        return flux
+
+    def transform(self, **attributes):
+        """Shallow copy of self with the given attributes replaced.
+
+        Transformations build only the arrays they change and hand them
+        in here, every other array is shared with self. Arrays are
+        therefore never modified in place once they belong to an object.
+        """
+        result = copy.copy(self)
+        for (name, value) in attributes.items():
+            setattr(result, name, value)
+        return result
+
+    def astype(self, dtype, inplace=False):
+        "self with its flux stored as dtype, unchanged if it already is"
+        if self.flux.dtype == dtype:
+            return self
+        return self.update(inplace, flux=self.flux.astype(dtype))
 
     def format(self, header=''):
         out = io.StringIO()
@@ -136,8 +586,17 @@ class Base(object):
         header = '# ' + header
         return '\n'.join([header, out.getvalue()])
 
-    def read_from_path(self, path, *args, **kwargs):
-        mat = np.array(np.loadtxt(path).transpose())
+    def read_from_path(self, path, columns=None, wavelength_range=None):
+        """Read a text table, wavelength first then one column per flux.
+
+        columns selects flux columns and wavelength_range (start, end) the
+        rows, see TextCache.window_lines; everything else is never parsed.
+        """
+        usecols = None
+        if columns is not None:
+            usecols = tuple([0] + [int(c) + 1 for c in columns])
+        mat = TextCache.loadtxt(path, transpose=True, usecols=usecols,
+                                wavelength_range=wavelength_range)
         basename = os.path.basename(path)
         (name, ext) = os.path.splitext(basename)
         self.name = basename
@@ -146,26 +605,46 @@ class Base(object):
         self.wavelength_step = self.wavelength[1] - self.wavelength[0]
         self.flux = mat[1:]
 
-    def normalize(self, wavelength):
-        result = copy.deepcopy(self)
-        index = result.wavelength.searchsorted(wavelength)
-        flux = result.flux.transpose()
-        if index >= result.num_wl:
-            return result
-        flux[0:index] /= flux[index]
-        flux[index+1:] /= flux[index]
-        flux[index] = [1]
-        result.name = self.name
+    @staticmethod
+    def normalized_flux(flux, index):
+        result = flux / flux[..., index:index+1]
+        result[..., index] = 1
         return result
 
-    def normalize_average(self):    #Dividing the fluxes with their average.
-        result = copy.deepcopy(self)
-        flux = result.flux.transpose()
-        averageFlux = reduce(lambda x,y: x + y, flux[:]) / len(flux)
-        flux[:] /= averageFlux
-        result.name = self.name
-        return result
-        
+    @staticmethod
+    def average_flux(flux):
+        flux = flux.transpose()
+        return np.asarray(reduce(lambda x,y: x + y, flux[:]) / len(flux))
+
+    @staticmethod
+    def average_normalized_flux(flux):
+        return flux / Base.average_flux(flux)[..., np.newaxis]
+
+    def normalize(self, wavelength, inplace=False):
+        index = self.wavelength.searchsorted(wavelength)
+        if index >= self.num_wl:
+            return self.update(inplace)
+        if self.is_lazy:
+            return self.update(inplace, normalization=wavelength,
+                               plan=self.plan + (('normalize', index),))
+        if inplace:
+            flux = self.writable_flux()
+            flux /= flux[..., index:index+1].copy()
+            flux[..., index] = 1
+        else:
+            flux = Base.normalized_flux(self.flux, index)
+        return self.update(inplace, flux=flux, normalization=wavelength)
+
+    def normalize_average(self, inplace=False):    #Dividing the fluxes with their average.
+        if self.is_lazy:
+            return self.update(inplace, normalization='average',
+                               plan=self.plan + (('average',),))
+        if inplace:
+            flux = self.writable_flux()
+            flux /= Base.average_flux(flux)[..., np.newaxis]
+        else:
+            flux = Base.average_normalized_flux(self.flux)
+        return self.update(inplace, flux=flux, normalization='average')
 
     def wavelength_str(self, start=None, end=None):
         wl = self.wavelength[start:end]
@@ -200,24 +679,27 @@ class Base(object):
         (index_start, index_end) = self.wavelength_index(start, end)
         return self.flux[:, index_start:index_end]
 
-    def wavelength_set_index(self, start, end):
-        result = copy.deepcopy(self)
-        result.wavelength = self.wavelength[start:end]
-        result.flux = self.flux[:, start:end]
-        return result
-
-    def wavelength_set_start(self, start):
+    def wavelength_set_index(self, start, end, inplace=False):
+        if self.is_lazy:
+            (start, end, _) = slice(start, end).indices(self.num_wl)
+            return self.update(inplace,
+                               wavelength=self.wavelength[start:end],
+                               plan=self.plan + (('index', start, max(start, end)),))
+        return self.update(inplace,
+                           wavelength=self.wavelength[start:end],
+                           flux=self.flux[:, start:end])
+
+    def wavelength_set_start(self, start, inplace=False):
         index_start = np.searchsorted(self.wavelength, start)
-        return self.wavelength_set_index(index_start, None)
+        return self.wavelength_set_index(index_start, None, inplace)
 
-    def wavelength_set_end(self, end):
+    def wavelength_set_end(self, end, inplace=False):
         index_end = np.searchsorted(self.wavelength, end)
-        return self.wavelength_set_index(0, index_end+1)
+        return self.wavelength_set_index(0, index_end+1, inplace)
 
     def restrict_wavelength_start(self, wavelength):
         index = np.searchsorted(self.wavelength, wavelength)
-        self.wavelength = self.wavelength[index:]
-        self.flux = self.flux[:, index:]
+        Base.wavelength_set_index(self, index, None, inplace=True)
 
     def restrict_wavelength_start_by_interpolation_step(self, interp, wavelength):
         step = interp / self.wavelength_step
@@ -228,19 +710,31 @@ class Base(object):
         self.restrict_wavelength_start(wl_start)
         return wl_start
 
-    def wavelength_set_range(self, start, end):
+    def wavelength_set_range(self, start, end, inplace=False):
         (index_start, index_end) = self.wavelength_index(start, end)
-        return self.wavelength_set_index(index_start, index_end+1)
+        return self.wavelength_set_index(index_start, index_end+1, inplace)
 
-    def smoothen(self, interp, name='', step=0):
+    def smoothen(self, interp, name='', step=0, inplace=False):
         if step <= 0:
             step = self.wavelength_step
-        result = copy.deepcopy(self)
-        result.name = name
-        result.wavelength = Math.wavelength_interpolate_step(
+        wavelength = Math.wavelength_interpolate_step(
             self.wavelength, interp, step)
-        result.flux = Math.flux_interpolate_step(self.flux, interp, step)
-        return result
+        if self.is_lazy:
+            return self.update(inplace, name=name, wavelength=wavelength,
+                               plan=self.plan_smoothing(interp, step, False))
+        flux = self.writable_flux() if inplace else self.flux
+        return self.update(
+            inplace,
+            name=name,
+            wavelength=wavelength,
+            flux=Math.flux_interpolate_step(flux, interp, step, inplace))
+
+    def plan_smoothing(self, interp, step, obsv):
+        if interp == step:
+            return self.plan
+        (starts, nsample) = Math.smoothing_windows(
+            self.num_wl, interp, step, obsv)
+        return self.plan + (('smooth', starts, nsample, obsv),)
 
     @property
     def name(self):
@@ -265,7 +759,8 @@ class Base(object):
 
     @property
     def num(self):
-        return self.flux.shape[0]
+        # Planned steps never change the number of rows
+        return self._flux.shape[0]
 
     @property
     def num_wl(self):
@@ -280,10 +775,51 @@ class Base(object):
 
     @property
     def flux(self):
+        if self._plan:
+            self._flux = Plan.run(self._flux, self._plan)
+            self._plan = ()
         return self._flux
     @flux.setter
     def flux(self, flux):
+        # Only a view of a flux self owns stays owned, any other array
+        # may still be held by whoever handed it in
+        self._owns_flux = self._owns_flux and flux is not None and \
+            self._flux is not None and np.may_share_memory(flux, self._flux)
         self._flux = flux
+        if self._plan:
+            self._plan = ()
+
+    @property
+    def plan(self):
+        "Steps still to run on the flux, None unless the object is lazy"
+        return self._plan
+    @plan.setter
+    def plan(self, plan):
+        self._plan = plan
+
+    @property
+    def is_lazy(self):
+        return self._plan is not None
+
+    @property
+    def lazy(self):
+        return self.is_lazy
+    @lazy.setter
+    def lazy(self, lazy):
+        "Start recording flux operations, or run the recorded ones and stop"
+        if lazy and self._plan is None:
+            self._plan = ()
+        elif not lazy and self._plan is not None:
+            self.flux
+            self._plan = None
+
+    @property
+    def normalization(self):
+        "None, the normalization wavelength or 'average'"
+        return self._normalization
+    @normalization.setter
+    def normalization(self, normalization):
+        self._normalization = normalization
 
     @property
     def var_start(self):
@@ -303,10 +839,14 @@ class Base(object):
     def var(self):
         if not self._var is None:
             return self._var
-        else:
-            return np.arange(self.var_start,
-                             self.var_start + (self.var_step * self.num),
-                             self.var_step)[:self.num]
+        # Built once per (start, step, num), read-only as copies share it
+        key = (self._var_start, self._var_step, self.num)
+        if self._var_axis is None or self._var_axis[0] != key:
+            (start, step, num) = key
+            axis = np.arange(start, start + (step * num), step)[:num]
+            axis.flags.writeable = False
+            self._var_axis = (key, axis)
+        return self._var_axis[1]
     @var.setter
     def var(self, var):
         self._var = var
@@ -315,11 +855,14 @@ class Base(object):
 
 class Model(Base):
 
+    __slots__ = ()
+
     PADOVA_WL_START     = 3322
     PADOVA_WL_END       = 9300
     PADOVA_ROUND_DIGITS = 2
     PADOVA_AGE_START    = 6.2
     PADOVA_AGE_END      = 10.10
+    DELGADO_COLUMNS     = np.arange(0, 220, 3)
     MODEL_FORMATS       = ['DELGADO', 'GALAXEV', 'MILES', 'INTERMEDIATE']
 
     def __init__(self,
@@ -327,30 +870,33 @@ class Model(Base):
                  age_step=0.05,
                  path=None,
                  format=None,
+                 wavelength_range=None,
                  *args, **kwargs):
         super(Model, self).__init__(path=None, *args, **kwargs)
         self.age_start = age_start
         self.age_step = age_step
         if not path is None:
-            self.read_from_path(path, format=format)
+            self.read_from_path(path, format=format,
+                                wavelength_range=wavelength_range)
 
     def format(self):
         ages_str = ', '.join(map(str, self.age))
         return super(Model, self).format(header=ages_str)
 
-    def read_from_path(self, path, format='DELGADO'):
+    def read_from_path(self, path, format='DELGADO', wavelength_range=None):
         if format == 'DELGADO':
-            self.read_del_gado_model(path)
+            self.read_del_gado_model(path, wavelength_range)
         elif format == 'GALAXEV':
-            self.read_galaxev_model(path)
+            self.read_galaxev_model(path, wavelength_range)
         elif format == 'MILES':
-            self.read_miles_model(path)
+            self.read_miles_model(path, wavelength_range)
         elif format == 'INTERMEDIATE':
-            self.read_intermediate_model(path)
+            self.read_intermediate_model(path, wavelength_range)
         else:
-            super(Model, self).read_from_path(path)
+            super(Model, self).read_from_path(
+                path, wavelength_range=wavelength_range)
 
-    def read_intermediate_model(self, path):
+    def read_intermediate_model(self, path, wavelength_range=None):
         from StringIO import StringIO
         with open(path) as f:
             try:
@@ -361,18 +907,30 @@ class Model(Base):
               self.age_step = self.age[1] - self.age[0]
             except:
               raise ValueError('Model has no age header specified')
-        super(Model, self).read_from_path(path)
+        super(Model, self).read_from_path(
+            path, wavelength_range=wavelength_range)
 
-    def read_del_gado_model(self, path):
-        super(Model, self).read_from_path(path)
-        model_indices = np.arange(0, 220, 3)
-        self.flux = self.flux[model_indices]
+    def read_del_gado_model(self, path, wavelength_range=None):
+        super(Model, self).read_from_path(
+            path, columns=Model.DELGADO_COLUMNS,
+            wavelength_range=wavelength_range)
         self.age = np.arange(self.age_start,
             self.age_start + self.age_step*self.num)
 
-    def read_galaxev_model(self, path):
-        f = open(path, 'r')
-        read_float_line = lambda: map(float, f.readline().split())
+    @staticmethod
+    def galaxev_block(values, pos):
+        "Count-prefixed block of an ised_ASCII file at pos, and the position after it"
+        if pos >= len(values):
+            raise ValueError('GALAXEV file ended before all spectra were read')
+        end = pos + 1 + int(values[pos])
+        if end > len(values):
+            raise ValueError('GALAXEV block truncated: expected {} values, read {}'.format(
+                end - pos - 1, len(values) - pos - 1))
+        return (values[pos+1:end], end)
+
+    def read_galaxev_model(self, path, wavelength_range=None):
+        f = open(path, 'rb')
+        read_float_line = lambda: list(map(float, f.readline().split()))
         spectra_hd = read_float_line()
         num_spectra, spectra = int(spectra_hd[0]), [spectra_hd[1:]]
         num_spectra_left = num_spectra - len(spectra[0])
@@ -394,20 +952,6 @@ class Model(Base):
             wavelength += wl_line
             num_wl_left -= len(wl_line)
 
-        total_flux = []
-        contents = iter(f.read().split())
-        for i in range(num_spectra):
-            flux = []
-            num_flux = int(next(contents))
-            for j in range(num_flux):
-                flux.append(float(next(contents)))
-
-            num_skip = int(next(contents))
-            for k in range(num_skip):
-                next(contents)
-            total_flux.append(flux)
-
-        f.close()
         basename = os.path.basename(path)
         (name, ext) = os.path.splitext(basename)
         self.name = basename
@@ -416,7 +960,7 @@ class Model(Base):
 
         # Skip Age Zero
         spectra = reduce(lambda x,y: x+y, spectra)[1:]
-        age = map(lambda x: round(math.log10(x), Model.PADOVA_ROUND_DIGITS), spectra)
+        age = [round(math.log10(x), Model.PADOVA_ROUND_DIGITS) for x in spectra]
         age_start_index = np.searchsorted(age, Model.PADOVA_AGE_START)
         age_end_index = np.searchsorted(age, Model.PADOVA_AGE_END)+1
         if len(age) > 1:
@@ -425,17 +969,33 @@ class Model(Base):
         self.age_start = age[0]
         self.age_step = age_step
 
-        # Skip Age Zero
-        total_flux = total_flux[1:]
-        self.flux = np.array(total_flux[age_start_index:age_end_index])
-        result = self.wavelength_set_range(
-            Model.PADOVA_WL_START, Model.PADOVA_WL_END)
-        self.wavelength = result.wavelength
-        self.wavelength_step = result.wavelength_step
-        self.flux = result.flux
-
-    def read_miles_model(self, path):
-        super(Model, self).read_from_path(path)
+        # The flux blocks are converted in one NumPy pass and walked by
+        # offset, only the wanted ages and wavelengths are copied out.
+        # Block i holds age[i-1], block 0 is age zero.
+        (wl_start, wl_end) = (Model.PADOVA_WL_START, Model.PADOVA_WL_END)
+        if wavelength_range is not None:
+            wl_start = max(wl_start, wavelength_range[0])
+            wl_end = min(wl_end, wavelength_range[1])
+        (wl_start, wl_end) = self.wavelength_index(wl_start, wl_end)
+        first = 1 + min(age_start_index, len(age))
+        last = 1 + min(age_end_index, len(age))
+        values = np.fromstring(f.read(), sep=' ')
+        f.close()
+
+        (total_flux, pos) = ([], 0)
+        for i in range(last):
+            (flux, pos) = Model.galaxev_block(values, pos)
+            if i >= first:
+                total_flux.append(flux[wl_start:wl_end+1])
+            (skipped, pos) = Model.galaxev_block(values, pos)
+
+        self.wavelength = self.wavelength[wl_start:wl_end+1]
+        self.wavelength_step = self.wavelength[1] - self.wavelength[0]
+        self.flux = np.array(total_flux)
+
+    def read_miles_model(self, path, wavelength_range=None):
+        super(Model, self).read_from_path(
+            path, wavelength_range=wavelength_range)
         with open(path) as f:
             try:
                 header = f.readline().lstrip('#')
@@ -476,17 +1036,18 @@ class Model(Base):
 
 #===============================================================================
 
-class Observation(Base):
+class Extinction(object):
+    """Extinction curves cached by wavelength grid.
 
-    def __init__(self,
-                 reddening_start = 0,
-                 reddening_step = 0.01,
-                 *args, **kwargs):
-        super(Observation, self).__init__(*args, **kwargs)
-        self.reddening_start = reddening_start
-        self.reddening_step = reddening_step
+    Observations of a survey usually share one grid, the curve is then
+    evaluated once instead of on every reddening_shift.
+    """
 
-    def wl_scale(self, wavelength):
+    CACHE_SIZE = 16
+    _cache     = collections.OrderedDict()
+
+    @staticmethod
+    def wl_scale(wavelength):
         WL_SCALE = 1e-4
         WL_EXPT  = -1
         WL_ADD   = -1.82
@@ -494,11 +1055,9 @@ class Observation(Base):
         a = (b ** WL_EXPT) + WL_ADD
         return a
 
-    def calculate_A(self):
-        return np.array([self.wl_scale(w) for w in self.wavelength])
-
-    def find_xyz(self):
-        A = self.calculate_A()
+    @staticmethod
+    def xyz(wavelength):
+        A = Extinction.wl_scale(np.asarray(wavelength, dtype=float))
         X = 1 + 0.17699*A - 0.50447*(A**2) - 0.02427*(A**3) + 0.72085*(A**4) + \
             0.01979*(A**5) - 0.77530*(A**6) + 0.32999*(A**7)
         Y = 1.41338*A + 2.28305*(A**2) + 1.07233*(A**3) - 5.38434*(A**4) - \
@@ -506,46 +1065,284 @@ class Observation(Base):
         Z = X + (Y / 3.2)
         return np.array([X, Y, Z])
 
+    @staticmethod
+    def key(wavelength):
+        wl = np.ascontiguousarray(wavelength, dtype=float)
+        return (wl.shape, hashlib.sha1(wl.tobytes()).hexdigest())
+
+    @staticmethod
+    def curve(wavelength):
+        "(X, Y, Z) of a wavelength grid and its 10**(0.4*3.2*Z) base"
+        key = Extinction.key(wavelength)
+        cache = Extinction._cache
+        if key in cache:
+            entry = cache.pop(key)
+        else:
+            xyz = Extinction.xyz(wavelength)
+            entry = (xyz, 10**(0.4*3.2*xyz[2]))
+            while len(cache) >= Extinction.CACHE_SIZE:
+                cache.popitem(last=False)
+        cache[key] = entry
+        return entry
+
+#===============================================================================
+
+class Observation(Base):
+
+    __slots__ = ('_reddening_source', '_reddening_num',
+                 '_normalization_reference')
+
+    def __init__(self,
+                 reddening_start = 0,
+                 reddening_step = 0.01,
+                 *args, **kwargs):
+        self._reddening_source = None
+        self._reddening_num    = 0
+        self._normalization_reference = None
+        super(Observation, self).__init__(*args, **kwargs)
+        self.reddening_start = reddening_start
+        self.reddening_step = reddening_step
+
+    def wl_scale(self, wavelength):
+        return Extinction.wl_scale(wavelength)
+
+    def astype(self, dtype, inplace=False):
+        if self.is_deferred:
+            result = self
+        else:
+            result = super(Observation, self).astype(dtype, inplace)
+        source = self.reddening_source
+        if source is None or source.dtype == dtype:
+            return result
+        # result is a copy already unless only the source needs converting
+        return result.update(inplace or result is not self,
+                             reddening_source=source.astype(dtype))
+
+    def calculate_A(self):
+        return Extinction.wl_scale(self.wavelength)
+
+    def find_xyz(self):
+        return Extinction.curve(self.wavelength)[0]
+
+    def extinction_base(self):
+        "10**(0.4*3.2*Z), raised to E(B-V) it gives the reddening factor"
+        return Extinction.curve(self.wavelength)[1]
+
     def find_flux(self, start, end, step):
-        flux_initial = self.flux[0]
-        Z = self.find_xyz()[2]
         R = np.arange(start, end+step, step)
-        flux = np.array([
-            (10**(0.4*3.2*Z[i]*R)) * flux_initial[i] for i in range(len(Z))
-        ])
-        return flux.transpose()
+        return Observation.redden(self.flux[0], self.extinction_base(), R)
 
     def find_single_flux(self, start):  #Single Reddening
-        flux_initial = self.flux[0]
-        Z = self.find_xyz()[2]
-        R = start
-        flux = np.array([
-            (10**(0.4*3.2*Z[i]*R)) * flux_initial[i] for i in range(len(Z))
-        ])
-        return flux.transpose()
-
-    def reddening_shift(self, start, end, step):
-        result = copy.deepcopy(self)
-        result.reddening_start = start
-        result.reddening_step = step
-        result.flux = self.find_flux(start, end, step)
+        return Observation.redden(
+            self.flux[0], self.extinction_base(), [start])[0]
+
+    @staticmethod
+    def redden(flux, base, reddening):
+        """flux shifted by every E(B-V) in reddening.
+
+        flux may hold one spectrum or a stack of spectra on the same
+        grid, every spectrum gets one row per reddening from a single
+        broadcast multiply.
+        """
+        flux = np.asarray(flux)
+        factor = base ** np.asarray(reddening, dtype=float)[:, np.newaxis]
+        # Single precision flux stays single precision
+        return flux[..., np.newaxis, :] * factor.astype(flux.dtype, copy=False)
+
+    @staticmethod
+    def reddening_shift_many(observations, start, end, step):
+        """reddening_shift of every observation, grouped by wavelength grid.
+
+        Observations sharing a grid share one extinction curve and are
+        reddened together.
+        """
+        R = np.arange(start, end+step, step)
+        groups = {}
+        for (i, obsv) in enumerate(observations):
+            groups.setdefault(Extinction.key(obsv.wavelength), []).append(i)
+
+        results = [None] * len(observations)
+        for indices in groups.values():
+            first = observations[indices[0]]
+            sources = np.array([observations[i].flux[0] for i in indices])
+            fluxes = Observation.redden(sources, first.extinction_base(), R)
+            for (i, flux) in zip(indices, fluxes):
+                result = observations[i].reddening_shift(
+                    start, end, step, defer=True)
+                result.flux = flux
+                results[i] = result
+        return results
+
+    def reddened_flux(self, reddening):
+        """Rows of the reddening source shifted by each E(B-V) in reddening.
+
+        Normalization recorded after reddening_shift is applied again, so
+        a row equals the matching row of the materialized flux.
+        """
+        flux = Observation.redden(
+            self.reddening_source, self.extinction_base(), reddening)
+        return self.apply_normalization(flux, reddening)
+
+    def apply_normalization(self, flux, reddening):
+        """Normalize rows of flux, reddened by reddening, as normalize or
+        normalize_average did.
+
+        The divisors are rebuilt from normalization_reference, the pixels
+        of the grid as it was when normalizing, so a later wavelength cut
+        does not move them.
+        """
+        if self.normalization_reference is None:
+            if self.normalization is not None:
+                raise ValueError('Normalized observation has no '
+                                 'normalization reference')
+            return flux
+        (source, base) = self.normalization_reference
+        divisor = np.mean(Observation.redden(source, base, reddening), axis=-1)
+        return flux / divisor.astype(flux.dtype, copy=False)[..., np.newaxis]
+
+    def normalization_window(self, start, end):
+        "(reddening source, extinction base) of the pixels start:end"
+        return (self.reddening_source[start:end],
+                self.extinction_base()[start:end])
+
+    def rows(self, indices):
+        "flux[indices] without building the other rows of a deferred flux"
+        if self.is_deferred:
+            return self.reddened_flux(self.reddening[indices])
+        return self.flux[indices]
+
+    def reddening_shift(self, start, end, step, defer=False):
+        """Shift the observation over a reddening range.
+
+        With defer only the unreddened flux is kept, rows are rebuilt
+        when flux is read and the fused engine never builds them at all.
+        """
+        result = self.transform(reddening_start=start,
+                                reddening_step=step,
+                                reddening_source=self.flux[0],
+                                normalization=None,
+                                normalization_reference=None)
+        if defer:
+            result.reddening_num = len(np.arange(start, end+step, step))
+            result.flux = None
+        else:
+            result.flux = self.find_flux(start, end, step)
         return result
 
     def single_reddening_shift(self, start):    #Single Reddening
-        result = copy.deepcopy(self)
-        result.reddening_start = start
-        result.flux = self.find_single_flux(start)
+        return self.transform(reddening_start=start,
+                              flux=self.find_single_flux(start),
+                              reddening_source=self.flux[0],
+                              normalization=None,
+                              normalization_reference=None)
+
+    def normalize(self, wavelength, inplace=False):
+        index = self.wavelength.searchsorted(wavelength)
+        if index >= self.num_wl:
+            return self.update(inplace)
+        if self.is_deferred:
+            result = self.update(inplace, normalization=wavelength)
+        else:
+            result = super(Observation, self).normalize(wavelength, inplace)
+        return self.record_normalization(result, index, index+1)
+
+    def normalize_average(self, inplace=False):
+        if self.is_deferred:
+            result = self.update(inplace, normalization='average')
+        else:
+            result = super(Observation, self).normalize_average(inplace)
+        return self.record_normalization(result, 0, None)
+
+    def record_normalization(self, result, start, end):
+        """Set the normalization_reference of result, normalized by the
+        pixels start:end of self, eager or deferred alike so reddened_flux
+        and the fused engine rebuild normalized rows either way"""
+        reference = None
+        if self.reddening_source is not None:
+            reference = self.normalization_window(start, end)
+        # result is self when normalizing in place, a fresh copy otherwise
+        result.normalization_reference = reference
+        return result
+
+    def wavelength_set_index(self, start, end, inplace=False):
+        if self.is_deferred:
+            result = self.update(inplace, wavelength=self.wavelength[start:end])
+        else:
+            result = super(Observation, self).wavelength_set_index(
+                start, end, inplace)
+        if self.reddening_source is not None:
+            result.reddening_source = self.reddening_source[start:end]
         return result
 
-    def smoothen(self, interp, name='', step=0):
+    def restrict_wavelength_start(self, wavelength):
+        index = np.searchsorted(self.wavelength, wavelength)
+        if self.is_deferred:
+            self.wavelength = self.wavelength[index:]
+        else:
+            super(Observation, self).restrict_wavelength_start(wavelength)
+        if self.reddening_source is not None:
+            self.reddening_source = self.reddening_source[index:]
+
+    def smoothen(self, interp, name='', step=0, inplace=False):
         if step <= 0:
             step = self.wavelength_step
-        result = copy.deepcopy(self)
-        result.name = name
-        result.wavelength = Math.wavelength_interpolate_step_obsv(
+        wavelength = Math.wavelength_interpolate_step_obsv(
             self.wavelength, interp, step)
-        result.flux = Math.flux_interpolate_step_obsv(self.flux, interp, step)
-        return result
+        # Smoothing does not commute with the per-pixel reddening factor
+        if self.is_lazy:
+            return self.update(inplace, name=name, wavelength=wavelength,
+                               plan=self.plan_smoothing(interp, step, True),
+                               reddening_source=None)
+        flux = self.writable_flux() if inplace else self.flux
+        return self.update(
+            inplace,
+            name=name,
+            wavelength=wavelength,
+            flux=Math.flux_interpolate_step_obsv(flux, interp, step, inplace),
+            reddening_source=None)
+
+    @property
+    def flux(self):
+        if self.is_deferred:
+            return self.reddened_flux(self.reddening)
+        return Base.flux.fget(self)
+    @flux.setter
+    def flux(self, flux):
+        Base.flux.fset(self, flux)
+
+    @property
+    def num(self):
+        if self.is_deferred:
+            return self.reddening_num
+        return self._flux.shape[0]
+
+    @property
+    def is_deferred(self):
+        "True if reddened rows are rebuilt from reddening_source on demand"
+        return self._flux is None
+
+    @property
+    def reddening_num(self):
+        return self._reddening_num
+    @reddening_num.setter
+    def reddening_num(self, reddening_num):
+        self._reddening_num = reddening_num
+
+    @property
+    def reddening_source(self):
+        "Flux before reddening_shift, None if the rows can not be rebuilt"
+        return self._reddening_source
+    @reddening_source.setter
+    def reddening_source(self, reddening_source):
+        self._reddening_source = reddening_source
+
+    @property
+    def normalization_reference(self):
+        "normalization_window of the pixels the last normalization divided by"
+        return self._normalization_reference
+    @normalization_reference.setter
+    def normalization_reference(self, normalization_reference):
+        self._normalization_reference = normalization_reference
 
     @property
     def reddening_start(self):
@@ -570,9 +1367,32 @@ class Observation(Base):
 
 #===============================================================================
 
-class Asad(object):
+class Asad(Compact):
 
     ROUND_DIGITS = 2
+    STAT_ENGINES = ['vectorized', 'tiled', 'fused', 'loop']
+    MAX_MEMORY_MB = 512
+    SEARCH_MODES = ['grid', 'coarse', 'continuous']
+    PRECISIONS = ['double', 'single']
+    COARSE_POINTS = 16
+    COARSE_CANDIDATES = 3
+    BRACKET_POINTS = 11
+    REDDENING_TOLERANCE = 1e-10
+    FIT_ATTRIBUTES = ['stat', 'chosen_model', 'min_observation', 'min_model',
+                      'min_stat', 'tile_size', 'evaluated_cells',
+                      'model_reddening']
+
+    __slots__ = ('_name', '_observation', '_model', '_stat_test', '_engine',
+                 '_max_memory_mb', '_tile_size', '_search', '_coarse_candidates',
+                 '_evaluated_cells',
+                 '_model_reddening', '_path', '_min_stat', '_min_observation',
+                 '_min_model', '_stat', '_chosen_model', '_error',
+                 'error_reddening', 'error_age', 'error_stat')
+
+    @staticmethod
+    def precision_dtype(precision):
+        "Storage dtype of a name in PRECISIONS, statistics are summed in double"
+        return {'double' : np.float64, 'single' : np.float32}[precision]
 
     @staticmethod
     def from_observation_model(observation, model):
@@ -583,15 +1403,26 @@ class Asad(object):
         return obj
 
     def __init__(self,
-                 name      = None,
-                 stat_test = Statistics.chi_squared_freq_test,
-                 path      = None,
-                 read      = True,
-                 calculate = False):
+                 name          = None,
+                 stat_test     = Statistics.chi_squared_freq_test,
+                 path          = None,
+                 read          = True,
+                 calculate     = False,
+                 engine        = 'vectorized',
+                 max_memory_mb = MAX_MEMORY_MB,
+                 search        = 'grid',
+                 coarse_candidates = COARSE_CANDIDATES):
         self._name            = name
         self._observation     = Observation()
         self._model           = Model()
         self._stat_test       = stat_test
+        self._engine          = engine
+        self._max_memory_mb   = max_memory_mb
+        self._tile_size       = None
+        self._search          = search
+        self._coarse_candidates = coarse_candidates
+        self._evaluated_cells = 0
+        self._model_reddening = None
         self._path            = path
         self._min_stat        = 0
         self._min_observation = 0
@@ -606,7 +1437,7 @@ class Asad(object):
                     self.calculate_chosen_model()
 
     def read_from_path(self, path, num_observation=51):
-        mat = np.array(np.loadtxt(path).transpose())
+        mat = TextCache.loadtxt(path, transpose=True)
         self.observation            = Observation()
         self.observation.wavelength = mat[0]
         self.observation.flux       = mat[1:num_observation+1]
@@ -614,6 +1445,15 @@ class Asad(object):
         self.model.wavelength       = mat[num_observation+1]
         self.model.flux             = mat[num_observation+2:]
 
+    def __getstate__(self):
+        state = Compact.__getstate__(self)
+        state['_stat_test'] = Statistics.stat_test_name(self._stat_test)
+        return state
+
+    def __setstate__(self, state):
+        Compact.__setstate__(self, state)
+        self._stat_test = Statistics.stat_tests()[state['_stat_test']]
+
     def format(self):
         obsv_fmt = self.observation.format().split('\n')
         model_fmt = self.model.format().split('\n')
@@ -631,36 +1471,187 @@ class Asad(object):
         return unicode(fmt)
 
     def normalize(self, wavelength):
-        result = copy.deepcopy(self)
-        result.observation = result.observation.normalize(wavelength)
-        result.model = result.model.normalize(wavelength)
+        result = copy.copy(self)
+        result.observation = self.observation.normalize(wavelength)
+        result.model = self.model.normalize(wavelength)
         return result
 
     def calculate_stat(self):
-        self.stat = np.zeros([self.num_observation, self.num_model])
-        for i in range(self.num_observation):
-            for j in range(self.num_model):
-                self.stat[i,j] = self.stat_test(
-                    self.observation.flux[i], self.model.flux[j])
+        matrix_test = Statistics.matrix_test(self.stat_test)
+        if self.engine == 'loop' or matrix_test is None:
+            return self.calculate_stat_loop()
+        if self.engine == 'fused':
+            self.stat = self.calculate_stat_fused()
+        elif self.engine == 'tiled':
+            (self.stat, self.tile_size) = Statistics.tiled_matrix(
+                self.stat_test, self.observation.flux, self.model.flux,
+                self.max_memory_mb)
+        else:
+            self.stat = matrix_test(self.observation.flux, self.model.flux)
+        return self.stat
+
+    def calculate_stat_loop(self):
+        "Reference implementation, one stat_test call per cell"
+        self.stat = Statistics.loop_matrix(
+            self.stat_test, self.observation.flux, self.model.flux)
+        return self.stat
+
+    def calculate_stat_fused(self):
+        obsv = self.observation
+        if obsv.reddening_source is None:
+            raise ValueError('Fused engine needs an observation '
+                             'reddening corrected with redshift')
+        return Statistics.fused_matrix(
+            self.stat_test, obsv.reddening_source, obsv.extinction_base(),
+            obsv.reddening, obsv.apply_normalization, self.model.flux)
+
+    def calculate_stat_coarse(self):
+        """Coarse-to-fine search of the reddening x age grid.
+
+        A decimated grid is evaluated first, then only the windows around
+        the coarse_candidates best cells are refined, halving the stride
+        until it reaches the full resolution. Cells never evaluated are
+        left at inf so they can not be chosen. A cell is never evaluated
+        twice, so evaluated_cells is the work done.
+
+        The search is approximate: an optimum between coarse points whose
+        neighbours all look worse than coarse_candidates other cells is
+        missed. More candidates refine more of the grid, as many as there
+        are cells makes it exhaustive.
+        """
+        matrix_test = Statistics.matrix_test(self.stat_test) or (
+            lambda xss, yss: Statistics.loop_matrix(self.stat_test, xss, yss))
+        shape = (self.num_observation, self.num_model)
+        self.stat = np.empty(shape)
+        self.stat.fill(np.inf)
+        evaluated = np.zeros(shape, dtype=bool)
+
+        def evaluate(rows, cols):
+            # Rows missing the same columns are evaluated together
+            groups = collections.OrderedDict()
+            for (row, todo) in zip(rows, ~evaluated[np.ix_(rows, cols)]):
+                if todo.any():
+                    groups.setdefault(todo.tobytes(), (todo, []))[1].append(row)
+            for (todo, group) in groups.values():
+                cells = np.ix_(group, cols[todo])
+                self.stat[cells] = matrix_test(
+                    self.observation.rows(np.array(group)),
+                    self.model.flux[cols[todo]])
+                evaluated[cells] = True
+
+        def window(center, radius, stride, num):
+            return np.arange(max(0, center - radius),
+                             min(num, center + radius + 1), stride)
+
+        strides = [Asad.coarse_stride(n) for n in shape]
+        evaluate(*[np.union1d(np.arange(0, n, s), [n - 1])
+                   for (n, s) in zip(shape, strides)])
+        while max(strides) > 1:
+            radius = strides
+            strides = [max(1, s // 2) for s in strides]
+            best = np.argsort(self.stat, axis=None)[:self.coarse_candidates]
+            for (row, col) in zip(*np.unravel_index(best, shape)):
+                evaluate(window(row, radius[0], strides[0], shape[0]),
+                         window(col, radius[1], strides[1], shape[1]))
+
+        self.evaluated_cells = int(np.sum(evaluated))
+        return self.stat
+
+    @staticmethod
+    def coarse_stride(num):
+        "Power of two stride leaving about COARSE_POINTS grid points"
+        stride = 1
+        while num // (2 * stride) >= Asad.COARSE_POINTS:
+            stride *= 2
+        return stride
+
+    def calculate_model_reddening(self):
+        """Best continuous E(B-V) of every model, with its statistic.
+
+        The observation is rebuilt from its reddening source, a scan of
+        BRACKET_POINTS reddenings brackets the minimum of every model,
+        then a golden-section search, run for all models at once, narrows
+        each bracket down to REDDENING_TOLERANCE.
+        """
+        obsv = self.observation
+        if obsv.reddening_source is None:
+            raise ValueError('Continuous reddening needs an observation '
+                             'reddening corrected with redshift')
+        models = self.model.flux
+        paired = lambda reddening: Statistics.paired_matrix(
+            self.stat_test, obsv.reddened_flux(reddening), models)
+
+        (start, end) = (obsv.reddening[0], obsv.reddening[-1])
+        scan = np.linspace(start, end, Asad.BRACKET_POINTS)
+        scan_stat = Statistics.matrix_test(self.stat_test)(
+            obsv.reddened_flux(scan), models)
+        best = np.argmin(scan_stat, axis=0)
+        a = scan[np.maximum(best - 1, 0)]
+        b = scan[np.minimum(best + 1, len(scan) - 1)]
+
+        ratio = (math.sqrt(5) - 1) / 2
+        c = b - ratio * (b - a)
+        d = a + ratio * (b - a)
+        (fc, fd) = (paired(c), paired(d))
+        while np.max(b - a) > Asad.REDDENING_TOLERANCE:
+            left = fc < fd
+            (a, b) = (np.where(left, a, c), np.where(left, d, b))
+            (c, d) = (np.where(left, b - ratio * (b - a), d),
+                      np.where(left, c, a + ratio * (b - a)))
+            x = np.where(left, c, d)
+            fx = paired(x)
+            (fc, fd) = (np.where(left, fx, fd), np.where(left, fc, fx))
+        reddening = (a + b) / 2
+        return (reddening, paired(reddening))
+
+    def calculate_stat_continuous(self):
+        """Fit a continuous reddening per model instead of a reddening grid.
+
+        stat keeps its grid shape for plotting, each model's statistic is
+        stored at the grid row nearest to its reddening, inf elsewhere.
+        """
+        (self.model_reddening, model_stat) = self.calculate_model_reddening()
+        rows = np.abs(self.observation.reddening[:, np.newaxis] -
+                      self.model_reddening[np.newaxis, :]).argmin(axis=0)
+        self.stat = np.empty([self.num_observation, self.num_model])
+        self.stat.fill(np.inf)
+        self.stat[rows, np.arange(self.num_model)] = model_stat
+        self.evaluated_cells = self.num_model
         return self.stat
 
     def calculate_chosen_model(self):
-        self.calculate_stat()
+        self.model_reddening = None
+        if self.search == 'coarse':
+            self.calculate_stat_coarse()
+        elif self.search == 'continuous':
+            self.calculate_stat_continuous()
+        else:
+            self.calculate_stat()
+            self.evaluated_cells = self.stat.size
         self.min_observation = np.argmin(np.min(self.stat, axis=1))
         self.min_model = np.argmin(self.stat[self.min_observation])
         self.chosen_model = np.argmin(self.stat, axis=1)
         self.min_stat = self.stat[self.min_observation, self.min_model]
         return self.chosen_model
 
+    def get_fit(self):
+        "Results of calculate_chosen_model, cheap to send between processes"
+        return dict((name, getattr(self, name)) for name in Asad.FIT_ATTRIBUTES)
+
+    def set_fit(self, fit):
+        for (name, value) in fit.items():
+            setattr(self, name, value)
+
     def calculate_stat_delta_level(self, delta=1.0):
         error = (np.abs(self.stat - self.min_stat) < delta)
         reddening_index = np.where([np.any(e) for e in error])[0]
         age_index = np.concatenate(np.array(
             [np.where(e)[0] for e in error]).flatten())
+        (stat, age) = (self.stat, self.model.age)
         self.error_reddening = self.observation.reddening[reddening_index]
-        self.error_age = np.array([self.model.age[i] for i in age_index])
+        self.error_age = np.array([age[i] for i in age_index])
         self.error_stat = np.array(
-            [self.stat[ri, ai] for ri, ai in zip(reddening_index, age_index)])
+            [stat[ri, ai] for ri, ai in zip(reddening_index, age_index)])
 
     @property
     def name(self):
@@ -690,6 +1681,58 @@ class Asad(object):
     def stat_test(self, stat_test):
         self._stat_test = stat_test
 
+    @property
+    def engine(self):
+        return self._engine
+    @engine.setter
+    def engine(self, engine):
+        if engine not in Asad.STAT_ENGINES:
+            raise ValueError('Unknown engine: {}, choose from: {}'.format(
+                engine, ', '.join(Asad.STAT_ENGINES)))
+        self._engine = engine
+
+    @property
+    def search(self):
+        return self._search
+    @search.setter
+    def search(self, search):
+        if search not in Asad.SEARCH_MODES:
+            raise ValueError('Unknown search: {}, choose from: {}'.format(
+                search, ', '.join(Asad.SEARCH_MODES)))
+        self._search = search
+
+    @property
+    def coarse_candidates(self):
+        "Best cells whose windows the coarse search refines at every level"
+        return self._coarse_candidates
+    @coarse_candidates.setter
+    def coarse_candidates(self, coarse_candidates):
+        if coarse_candidates < 1:
+            raise ValueError('coarse_candidates must be at least 1, given: {}'.format(
+                coarse_candidates))
+        self._coarse_candidates = coarse_candidates
+
+    @property
+    def evaluated_cells(self):
+        return self._evaluated_cells
+    @evaluated_cells.setter
+    def evaluated_cells(self, evaluated_cells):
+        self._evaluated_cells = evaluated_cells
+
+    @property
+    def max_memory_mb(self):
+        return self._max_memory_mb
+    @max_memory_mb.setter
+    def max_memory_mb(self, max_memory_mb):
+        self._max_memory_mb = max_memory_mb
+
+    @property
+    def tile_size(self):
+        return self._tile_size
+    @tile_size.setter
+    def tile_size(self, tile_size):
+        self._tile_size = tile_size
+
     @property
     def path(self):
         return self._path
@@ -728,8 +1771,18 @@ class Asad(object):
 
     @property
     def min_reddening(self):
+        if self.model_reddening is not None:
+            return self.model_reddening[self.min_model]
         return self.observation.reddening[self.min_observation]
 
+    @property
+    def model_reddening(self):
+        "Continuous best reddening of every model, None for grid searches"
+        return self._model_reddening
+    @model_reddening.setter
+    def model_reddening(self, model_reddening):
+        self._model_reddening = model_reddening
+
     @property
     def min_age(self):
         return self.model.age[self.min_model]
@@ -737,6 +1790,7 @@ class Asad(object):
     @property
     def stat(self):
         return self._stat
+    @stat.setter
     def stat(self, stat):
         self._stat = stat
 
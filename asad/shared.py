@@ -0,0 +1,61 @@
+import os, os.path
+import shutil
+import tempfile
+import uuid
+
+import numpy as np
+
+#===============================================================================
+
+class SharedArray(object):
+    "Picklable handle to an array kept in a memory-mapped .npy file"
+
+    def __init__(self, path):
+        self._path = path
+
+    def attach(self):
+        "Read-only view of the array, pages are shared between processes"
+        return np.load(self.path, mmap_mode='r')
+
+    @property
+    def path(self):
+        return self._path
+
+#===============================================================================
+
+class SharedStore(object):
+    """Temporary directory holding the arrays shared with worker processes.
+
+    Sending a SharedArray instead of the array itself means a task only
+    pickles a file name, every worker maps the same pages.
+    """
+
+    def __init__(self, directory=None):
+        self._directory = tempfile.mkdtemp(prefix='asad_shared_', dir=directory)
+
+    def share(self, array):
+        path = os.path.join(self.directory, uuid.uuid4().hex + '.npy')
+        np.save(path, np.ascontiguousarray(array))
+        return SharedArray(path)
+
+    def release(self, handle):
+        "Remove the file of a handle no worker reads any more"
+        try:
+            os.remove(handle.path)
+        except OSError:
+            pass
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def directory(self):
+        return self._directory
+
+#===============================================================================
@@ -0,0 +1,40 @@
+"""Small synthetic observations and models on a shared wavelength grid"""
+import numpy as np
+
+from asad import pyasad
+
+#===============================================================================
+
+WAVELENGTH_START = 3600.0
+WAVELENGTH_STEP  = 5.0
+NUM_WAVELENGTH   = 600
+
+def wavelength():
+    return WAVELENGTH_START + WAVELENGTH_STEP * np.arange(NUM_WAVELENGTH)
+
+def continuum(rng, num):
+    "num smooth spectra with a few absorption lines each"
+    wl = wavelength()
+    flux = 1 + 0.3 * np.sin(wl / rng.uniform(150, 400, (num, 1)))
+    for row in flux:
+        row[rng.randint(0, NUM_WAVELENGTH, 10)] *= 0.6
+    return flux
+
+def model(num=20, seed=0):
+    model = pyasad.Model(age_start=6.6, age_step=0.1)
+    model.name = model.original_name = 'synthetic_model'
+    model.wavelength = wavelength()
+    model.flux = continuum(np.random.RandomState(seed), num)
+    return model
+
+def observation(source=None, reddening=0.0, seed=1):
+    """Observation of source, the spectrum of a model row or a random one,
+    reddened by reddening"""
+    obsv = pyasad.Observation()
+    obsv.name = obsv.original_name = 'synthetic_observation'
+    obsv.wavelength = wavelength()
+    if source is None:
+        source = continuum(np.random.RandomState(seed), 1)[0]
+    obsv.flux = pyasad.Observation.redden(
+        source, obsv.extinction_base(), [reddening])
+    return obsv
@@ -0,0 +1,63 @@
+import os, os.path
+import shutil
+import tempfile
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from asad.cache import TextCache
+
+#===============================================================================
+
+class TestTextCache(object):
+
+    def setup(self):
+        self.saved = (TextCache.enabled, TextCache.directory)
+        self.root = tempfile.mkdtemp()
+        TextCache.enabled = True
+        TextCache.directory = os.path.join(self.root, 'cache')
+        self.path = os.path.join(self.root, 'spectrum.txt')
+        self.write(np.arange(20.0))
+
+    def teardown(self):
+        (TextCache.enabled, TextCache.directory) = self.saved
+        shutil.rmtree(self.root)
+
+    def write(self, flux):
+        np.savetxt(self.path, np.c_[3600 + 10 * np.arange(len(flux)), flux])
+        # A new modification time even within the file system's resolution
+        stat = os.stat(self.path)
+        os.utime(self.path, (stat.st_atime, stat.st_mtime + 10))
+
+    def entries(self):
+        return os.listdir(TextCache.directory)
+
+    def test_disabled_by_default(self):
+        assert self.saved[0] is False
+
+    def test_hit_returns_the_parsed_table(self):
+        first = TextCache.loadtxt(self.path, transpose=True)
+        second = TextCache.loadtxt(self.path, transpose=True)
+        assert isinstance(second, np.memmap)
+        assert_array_equal(second, first)
+        assert len(self.entries()) == 1
+
+    def test_edited_source_replaces_its_entry(self):
+        TextCache.loadtxt(self.path)
+        self.write(np.arange(30.0))
+        mat = TextCache.loadtxt(self.path)
+        assert mat.shape == (30, 2)
+        assert len(self.entries()) == 1
+
+    def test_read_windows_keep_one_entry(self):
+        TextCache.loadtxt(self.path, wavelength_range=(3650, 3700))
+        mat = TextCache.loadtxt(self.path, wavelength_range=(3700, 3750))
+        assert_array_equal(mat[:, 0], [3690, 3700, 3710, 3720, 3730, 3740, 3750])
+        assert len(self.entries()) == 1
+
+    def test_other_sources_are_kept(self):
+        other = os.path.join(self.root, 'other.txt')
+        shutil.copy(self.path, other)
+        TextCache.loadtxt(self.path)
+        TextCache.loadtxt(other)
+        assert len(self.entries()) == 2
@@ -0,0 +1,107 @@
+import copy
+import pickle
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from asad import pyasad
+import spectra
+
+#===============================================================================
+
+def assert_same_state(a, b):
+    assert type(a) is type(b)
+    assert not hasattr(b, '__dict__')
+    (state_a, state_b) = (a.__getstate__(), b.__getstate__())
+    assert sorted(state_a) == sorted(state_b)
+    for (name, value) in state_a.items():
+        other = state_b[name]
+        if isinstance(value, pyasad.Compact):
+            assert_same_state(value, other)
+        elif isinstance(value, np.ndarray):
+            assert_array_equal(other, value)
+        elif name == '_var_axis':
+            # Cached axis, rebuilt on demand
+            continue
+        elif isinstance(value, tuple):
+            assert len(value) == len(other)
+            for (x, y) in zip(value, other):
+                assert_array_equal(y, x)
+        else:
+            assert value == other, name
+
+def round_trips(value):
+    for protocol in (0, pickle.HIGHEST_PROTOCOL):
+        yield pickle.loads(pickle.dumps(value, protocol))
+    yield copy.copy(value)
+    yield copy.deepcopy(value)
+
+def deferred_observation():
+    return spectra.observation().reddening_shift(
+        0, 0.3, 0.01, defer=True).normalize_average()
+
+def fitted():
+    obj = pyasad.Asad.from_observation_model(
+        spectra.observation().reddening_shift(0, 0.3, 0.01), spectra.model())
+    obj.calculate_chosen_model()
+    return obj
+
+def test_bases_round_trip():
+    for make in (spectra.model, spectra.observation, deferred_observation):
+        value = make()
+        value.var
+        for result in round_trips(value):
+            assert_same_state(value, result)
+
+def test_deferred_observation_rebuilds_the_same_flux():
+    value = deferred_observation()
+    for result in round_trips(value):
+        assert result.is_deferred
+        assert_array_equal(result.flux, value.flux)
+
+def test_fitted_object_round_trips():
+    obj = fitted()
+    for result in round_trips(obj):
+        assert_same_state(obj, result)
+
+def test_unpickled_object_fits_the_same():
+    # What a fitting process pool worker receives
+    obj = pyasad.Asad.from_observation_model(
+        spectra.observation().reddening_shift(0, 0.3, 0.01), spectra.model())
+    worker = pickle.loads(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+    obj.calculate_chosen_model()
+    worker.calculate_chosen_model()
+    assert (worker.min_model, worker.min_observation) == \
+        (obj.min_model, obj.min_observation)
+    assert worker.min_stat == obj.min_stat
+
+def inplace_steps():
+    return [lambda base: base.normalize(4000.0, inplace=True),
+            lambda base: base.normalize_average(inplace=True),
+            lambda base: base.smoothen(15.0, inplace=True)]
+
+def check_inplace_leaves_the_other_unchanged(make, share, step):
+    value = make()
+    # value owns its flux once it has been modified in place
+    value.normalize_average(inplace=True)
+    other = share(value)
+    flux = value.flux.copy()
+    step(other)
+    assert_array_equal(value.flux, flux)
+    other_flux = other.flux.copy()
+    step(value)
+    assert_array_equal(other.flux, other_flux)
+
+def test_inplace_transform_of_a_copy_leaves_the_original_unchanged():
+    for make in (spectra.model, spectra.observation):
+        for share in (copy.copy, lambda base: base.transform(name='copy'),
+                      lambda base: base.wavelength_set_range(3700.0, 6000.0)):
+            for step in inplace_steps():
+                yield check_inplace_leaves_the_other_unchanged, make, share, step
+
+def test_owned_flux_is_modified_in_place():
+    model = spectra.model()
+    model.normalize_average(inplace=True)
+    flux = model.flux
+    model.normalize(4000.0, inplace=True)
+    assert model.flux is flux
@@ -0,0 +1,59 @@
+import os, os.path
+
+from numpy.testing import assert_array_equal
+
+from asad import interactive
+from asad import pyasad
+import spectra
+
+#===============================================================================
+
+REDDENING = (0, 0.3, 0.01)
+
+def objects(observation, models):
+    return [pyasad.Asad.from_observation_model(observation, model)
+            for model in models]
+
+def test_kept_pool_shares_models_once():
+    models = [spectra.model(seed=0), spectra.model(seed=1)]
+    observations = [spectra.observation(seed=i).reddening_shift(*REDDENING)
+                    for i in range(3)]
+    shell = interactive.Object_Shell()
+    shell.jobs = 2
+    shell.keep_pool = True
+    try:
+        paths = set()
+        for observation in observations:
+            shell.values = objects(observation, models)
+            shell.do_calculate_chosen_model('chi-squared')
+            store = shell._store
+            # Wavelength and flux of each model, the observation is gone
+            assert len(os.listdir(store.directory)) == 2 * len(models)
+            assert not observation._shared
+            paths.add(models[0]._shared['_flux'][0].path)
+            for (obj, expected) in zip(shell.values,
+                                       objects(observation, models)):
+                expected.calculate_chosen_model()
+                assert_array_equal(obj.stat, expected.stat)
+                assert obj.min_model == expected.min_model
+    finally:
+        shell.keep_pool = False
+        shell.close_pool()
+    assert len(paths) == 1
+    assert not os.path.exists(store.directory)
+    assert all(not model._shared for model in models)
+
+def test_failed_parallel_fits_are_dropped():
+    models = [spectra.model(seed=0), spectra.model(seed=1), spectra.model(seed=2)]
+    # Fewer wavelengths than the observation, this model can not be fitted
+    models[1].wavelength = models[1].wavelength[:-10]
+    models[1].flux = models[1].flux[:, :-10]
+    shell = interactive.Object_Shell()
+    shell.jobs = 2
+    shell.values = objects(spectra.observation().reddening_shift(*REDDENING),
+                           models)
+    (good, bad) = ([shell.values[0], shell.values[2]], shell.values[1])
+    shell.do_calculate_chosen_model('chi-squared')
+    assert shell.values == good
+    assert all(obj.stat is not None for obj in shell.values)
+    assert bad not in shell.values
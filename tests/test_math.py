@@ -0,0 +1,82 @@
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+
+from asad import pyasad
+
+Math = pyasad.Math
+
+#===============================================================================
+
+# (interp, step), including non-integer steps and ratios
+STEPS = [(3.0, 0.3), (3.0, 1.0), (3.0, 1.5), (2.5, 1.0), (3.0, 0.7),
+         (1.0, 0.25), (3.0, 3.0)]
+
+def reference(xs, interp, step, obsv):
+    """The smoothing loops boxcar replaced, windows start at the truncated
+    float index i * interp / step"""
+    if interp == step:
+        return np.array(xs, dtype=float)
+    sample_step = interp / step
+    nsample = int(2*sample_step - 1)
+    if obsv:
+        result_num = int(len(xs) / sample_step - 3)
+        (first, xs) = (xs[0], xs[1:])
+    else:
+        result_num = int(len(xs) / sample_step - 1)
+    result = np.zeros([result_num])
+    for i in range(result_num):
+        tot = 0
+        for k in range(nsample):
+            tot += xs[int(i*sample_step) + k]
+        result[i] = tot / nsample
+    if obsv:
+        return np.append(first, result)
+    return result
+
+def spectra(num=3, num_wl=403):
+    rng = np.random.RandomState(0)
+    return 1 + rng.rand(num, num_wl)
+
+def check_flux(interp, step, obsv):
+    xss = spectra()
+    expected = np.array([reference(xs, interp, step, obsv) for xs in xss])
+    smooth = (Math.flux_interpolate_step_obsv if obsv
+              else Math.flux_interpolate_step)
+    assert_allclose(smooth(xss, interp, step), expected, rtol=1e-12)
+    assert_allclose(smooth(xss.copy(), interp, step, inplace=True), expected,
+                    rtol=1e-12)
+
+def check_wavelength(interp, step, obsv):
+    xs = 3600 + 0.5 * np.arange(403)
+    smooth = (Math.wavelength_interpolate_step_obsv if obsv
+              else Math.wavelength_interpolate_step)
+    assert_allclose(smooth(xs, interp, step),
+                    reference(xs, interp, step, obsv), rtol=1e-12)
+
+def test_flux_interpolate_step():
+    for (interp, step) in STEPS:
+        yield (check_flux, interp, step, False)
+
+def test_flux_interpolate_step_obsv():
+    for (interp, step) in STEPS:
+        yield (check_flux, interp, step, True)
+
+def test_wavelength_interpolate_step():
+    for (interp, step) in STEPS:
+        yield (check_wavelength, interp, step, False)
+
+def test_wavelength_interpolate_step_obsv():
+    for (interp, step) in STEPS:
+        yield (check_wavelength, interp, step, True)
+
+def test_window_starts_truncate():
+    # 3 / 0.3 is slightly above 10, 3 / 0.7 is not an integer
+    assert_array_equal(Math.window_starts(4, 3 / 0.3), [0, 10, 20, 30])
+    assert_array_equal(Math.window_starts(4, 3 / 0.7), [0, 4, 8, 12])
+
+def test_boxcar_out_of_bounds():
+    try:
+        Math.boxcar(np.ones(10), np.array([0, 5]), 6)
+    except IndexError:
+        return
+    assert False, 'IndexError not raised'
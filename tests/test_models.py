@@ -0,0 +1,182 @@
+import math
+import os, os.path
+import shutil
+import tempfile
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from asad import pyasad
+
+Model = pyasad.Model
+
+#===============================================================================
+
+GALAXEV_LOG_AGES = np.arange(5.9, 10.35, 0.1)
+GALAXEV_WAVELENGTH = np.arange(3000.0, 9600.0, 20.0)
+GALAXEV_SKIPPED = 7
+
+def wrapped(values, per_line, first=None):
+    "Lines of per_line values, after first on the first line"
+    values = list(values)
+    head = [] if first is None else [first]
+    lines = [head + values[:per_line]]
+    lines += [values[i:i+per_line] for i in range(per_line, len(values), per_line)]
+    return '\n'.join(' '.join(str(x) for x in line) for line in lines) + '\n'
+
+def write_galaxev(path, seed=0):
+    "A small ised_ASCII file: ages, six header lines, wavelengths and blocks"
+    rng = np.random.RandomState(seed)
+    ages = [0.0] + list(10 ** GALAXEV_LOG_AGES)
+    with open(path, 'w') as f:
+        f.write(wrapped(['{:.6E}'.format(a) for a in ages], 5, len(ages)))
+        for i in range(6):
+            f.write(' header line {}\n'.format(i))
+        f.write(wrapped(GALAXEV_WAVELENGTH, 6, len(GALAXEV_WAVELENGTH)))
+        for age in ages:
+            flux = ['{:.6E}'.format(x) for x in rng.rand(len(GALAXEV_WAVELENGTH))]
+            f.write(wrapped(flux, 6, len(flux)))
+            skipped = ['{:.4E}'.format(x) for x in rng.rand(GALAXEV_SKIPPED)]
+            f.write(wrapped(skipped, 6, len(skipped)))
+
+def read_galaxev_lines(path):
+    "(age, wavelength, flux) as the line by line GALAXEV reader parsed them"
+    f = open(path, 'r')
+    read_float_line = lambda: list(map(float, f.readline().split()))
+    spectra_hd = read_float_line()
+    num_spectra, spectra = int(spectra_hd[0]), [spectra_hd[1:]]
+    num_spectra_left = num_spectra - len(spectra[0])
+    while num_spectra_left > 0:
+        spectra_line = read_float_line()
+        spectra.append(spectra_line)
+        num_spectra_left -= len(spectra_line)
+    for i in range(6):
+        f.readline()
+    wl_hd = read_float_line()
+    num_wl, wavelength = int(wl_hd[0]), wl_hd[1:]
+    num_wl_left = num_wl - len(wavelength)
+    while num_wl_left > 0:
+        wl_line = read_float_line()
+        wavelength += wl_line
+        num_wl_left -= len(wl_line)
+
+    total_flux = []
+    contents = iter(f.read().split())
+    for i in range(num_spectra):
+        flux = []
+        num_flux = int(next(contents))
+        for j in range(num_flux):
+            flux.append(float(next(contents)))
+        num_skip = int(next(contents))
+        for k in range(num_skip):
+            next(contents)
+        total_flux.append(flux)
+    f.close()
+
+    spectra = sum(spectra, [])[1:]
+    age = [round(math.log10(x), Model.PADOVA_ROUND_DIGITS) for x in spectra]
+    age_start_index = np.searchsorted(age, Model.PADOVA_AGE_START)
+    age_end_index = np.searchsorted(age, Model.PADOVA_AGE_END)+1
+    flux = np.array(total_flux[1:][age_start_index:age_end_index])
+    wavelength = np.array(wavelength)
+    wl_start = np.searchsorted(wavelength, Model.PADOVA_WL_START)
+    wl_end = np.searchsorted(wavelength, Model.PADOVA_WL_END) + 1
+    return (np.array(age[age_start_index:age_end_index]),
+            wavelength[wl_start:wl_end], flux[:, wl_start:wl_end])
+
+class TestGalaxev(object):
+
+    def setup(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'model.ised_ASCII')
+        write_galaxev(self.path)
+
+    def teardown(self):
+        shutil.rmtree(self.root)
+
+    def test_matches_line_by_line_reader(self):
+        (age, wavelength, flux) = read_galaxev_lines(self.path)
+        model = Model(path=self.path, format='GALAXEV')
+        # The fixture has ages on both sides of the PADOVA age range
+        assert 0 < len(age) < len(GALAXEV_LOG_AGES)
+        assert_array_equal(model.age, age)
+        assert_array_equal(model.wavelength, wavelength)
+        assert_array_equal(model.flux, flux)
+        assert model.name == 'model.ised_ASCII'
+
+    def test_truncated_file(self):
+        with open(self.path) as f:
+            text = f.read()
+        # Cut inside the blocks of the ages that are read
+        with open(self.path, 'w') as f:
+            f.write(text[:len(text) // 2])
+        try:
+            Model(path=self.path, format='GALAXEV')
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('truncated GALAXEV file was read')
+
+#===============================================================================
+
+DELGADO_WAVELENGTH = np.arange(3500.0, 6500.0, 1.0)
+DELGADO_NUM_COLUMNS = Model.DELGADO_COLUMNS[-1] + 2
+
+def write_table(path, wavelength, num_columns, seed=0):
+    "A text table, wavelength then num_columns flux columns"
+    rng = np.random.RandomState(seed)
+    np.savetxt(path, np.c_[wavelength, rng.rand(len(wavelength), num_columns)],
+               fmt='%.6f')
+
+def run_cut(base, normalize, interp=3.0, start=3800.0, end=6200.0):
+    "The model steps of a run: align, smooth, cut and normalize"
+    base.restrict_wavelength_start(start - 3 * interp)
+    base = base.smoothen(interp, step=base.wavelength_step)
+    base = base.wavelength_set_range(start, end)
+    return normalize(base)
+
+class TestReadWindow(object):
+
+    # config_read_window of a 3800-6200 run with an interpolation step of 3
+    WINDOW = (3788.0, 6212.0)
+
+    def setup(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'model.txt')
+        write_table(self.path, DELGADO_WAVELENGTH, DELGADO_NUM_COLUMNS)
+
+    def teardown(self):
+        shutil.rmtree(self.root)
+
+    def check_window_rows(self, full, windowed):
+        start = np.searchsorted(full.wavelength, self.WINDOW[0]) - 1
+        end = np.searchsorted(full.wavelength, self.WINDOW[1]) + 1
+        assert_array_equal(windowed.wavelength, full.wavelength[start:end])
+        assert_array_equal(windowed.flux, full.flux[:, start:end])
+
+    def test_delgado_columns(self):
+        full = Model(path=self.path, format='DELGADO')
+        windowed = Model(path=self.path, format='DELGADO',
+                         wavelength_range=self.WINDOW)
+        assert full.num == len(Model.DELGADO_COLUMNS)
+        self.check_window_rows(full, windowed)
+        assert_array_equal(windowed.age, full.age)
+
+    def test_every_column(self):
+        full = Model(path=self.path, format='MILES')
+        windowed = Model(path=self.path, format='MILES',
+                         wavelength_range=self.WINDOW)
+        assert full.num == DELGADO_NUM_COLUMNS
+        self.check_window_rows(full, windowed)
+
+    def check_run_steps(self, normalize):
+        full = run_cut(Model(path=self.path, format='DELGADO'), normalize)
+        windowed = run_cut(Model(path=self.path, format='DELGADO',
+                                 wavelength_range=self.WINDOW), normalize)
+        assert_array_equal(windowed.wavelength, full.wavelength)
+        assert_array_equal(windowed.flux, full.flux)
+
+    def test_run_steps_match_full_read(self):
+        for normalize in (lambda base: base.normalize(5870.0),
+                          lambda base: base.normalize_average()):
+            yield self.check_run_steps, normalize
@@ -0,0 +1,53 @@
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+
+from asad import pyasad
+import spectra
+
+Plan = pyasad.Plan
+
+#===============================================================================
+
+def transforms(base):
+    """The same cut, smooth, cut and normalize sequence, lazy or not.
+
+    Observations keep their first sample when smoothing, models do not.
+    """
+    base = base.wavelength_set_range(3700, 6200)
+    base = base.smoothen(3.0, name='smoothed', step=1.0)
+    base = base.wavelength_set_range(3900, 6000)
+    return base.normalize(5000).normalize_average()
+
+def check_lazy_matches_eager(make):
+    eager = transforms(make())
+    value = make()
+    value.lazy = True
+    lazy = transforms(value)
+    assert len(lazy.plan) == 5
+    assert_array_equal(lazy.wavelength, eager.wavelength)
+    assert_allclose(lazy.flux, eager.flux, rtol=1e-12)
+    assert lazy.plan == ()
+
+def test_lazy_model_matches_eager():
+    check_lazy_matches_eager(lambda: spectra.model(num=4))
+
+def test_lazy_observation_matches_eager():
+    check_lazy_matches_eager(spectra.observation)
+
+def test_fused_plan_matches_step_by_step():
+    make = lambda: spectra.model(num=4)
+    value = make()
+    value.lazy = True
+    steps = transforms(value).plan
+    flux = make().flux
+    # Runs the steps one at a time, nothing is fused
+    unfused = reduce(lambda flux, step: Plan.run(flux, (step,)), steps, flux)
+    assert_allclose(Plan.run(flux, steps), unfused, rtol=1e-12)
+
+def test_cut_after_smoothing_only_smooths_kept_windows():
+    flux = spectra.model(num=2).flux
+    (starts, nsample) = pyasad.Math.smoothing_windows(flux.shape[1], 3.0, 1.0)
+    steps = (('index', 10, 500), ('smooth', starts[:100], nsample, False),
+             ('index', 40, 60))
+    expected = pyasad.Math.boxcar(flux[:, 10:500], starts[:100], nsample)[:, 40:60]
+    assert_allclose(Plan.run(flux, steps), expected, rtol=1e-12)
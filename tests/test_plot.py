@@ -0,0 +1,183 @@
+import multiprocessing
+import os, os.path
+import pickle
+import re
+import shutil
+import tempfile
+
+import matplotlib.image
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from asad import plot
+from asad import pyasad
+import spectra
+
+#===============================================================================
+
+def fitted_objects(num=3):
+    model = spectra.model()
+    objs = []
+    for i in range(num):
+        obsv = spectra.observation(model.flux[2 * i], reddening=-0.013 - 0.05 * i)
+        obsv.name = 'observation_{}'.format(i)
+        obj = pyasad.Asad.from_observation_model(
+            obsv.reddening_shift(0, 0.3, 0.01), model)
+        obj.calculate_chosen_model()
+        objs.append(obj)
+    return objs
+
+def pixels(fig):
+    fig.canvas.draw()
+    return fig.canvas.tostring_rgb()
+
+def read_image(directory, name):
+    return matplotlib.image.imread(os.path.join(directory, name))
+
+def pixel_diff(a, b):
+    "Fraction of pixels that differ"
+    return (a != b).any(axis=-1).mean()
+
+KWARGS = {
+    'scatter' : {'ages' : [6.8, 7.5], 'reddenings' : [0.1]},
+}
+
+def test_plot_data_round_trip():
+    obj = fitted_objects(1)[0]
+    for kind in sorted(plot.PLOTS):
+        kwargs = KWARGS.get(kind, {})
+        data = plot.PlotData.for_plot(kind, obj, **kwargs)
+        sent = pickle.loads(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+        for part in ('model', 'observation'):
+            (a, b) = (getattr(data, part), getattr(sent, part))
+            assert_array_equal(b.wavelength, a.wavelength)
+            assert_array_equal(b.var, a.var)
+            assert sorted(b.flux) == sorted(a.flux)
+            for row in a.flux:
+                assert_array_equal(b.flux[row], getattr(obj, part).flux[row])
+        if kind == 'surface':
+            assert_array_equal(sent.stat, obj.stat)
+        assert pixels(plot.PLOTS[kind](sent, **kwargs)) == \
+            pixels(plot.PLOTS[kind](obj, **kwargs))
+
+class TestRenderPool(object):
+
+    def setup(self):
+        self.root = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.root)
+
+    def tasks(self, outdir):
+        kwargs = {'outdir' : outdir, 'save' : True, 'format' : 'png'}
+        tasks = [(kind, plot.PlotData.for_plot(kind, obj), kwargs)
+                 for obj in fitted_objects(2) for kind in sorted(plot.PLOTS)]
+        # A figure that fails: its best-fit row is missing
+        tasks[5][1].model.flux = {}
+        return tasks
+
+    def test_pool_matches_serial(self):
+        (serial_dir, pool_dir) = [os.path.join(self.root, name)
+                                  for name in ('serial', 'pool')]
+        for directory in (serial_dir, pool_dir):
+            os.mkdir(directory)
+        serial = [plot.render(task) for task in self.tasks(serial_dir)]
+        pool = multiprocessing.Pool(2)
+        try:
+            parallel = pool.map(plot.render, self.tasks(pool_dir), chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        assert [i for (i, err) in enumerate(serial) if err] == [5]
+        assert parallel == serial
+        files = sorted(os.listdir(serial_dir))
+        assert len(files) == len(serial) - 1
+        assert sorted(os.listdir(pool_dir)) == files
+        # Workers inherit the text layout state of whatever they drew before,
+        # text can land a few pixels away from the serial figure. Each pool
+        # figure has to be nearer its own serial figure than any other one.
+        serial_images = dict((name, read_image(serial_dir, name))
+                             for name in files)
+        for name in files:
+            image = read_image(pool_dir, name)
+            distances = dict((other, pixel_diff(image, expected))
+                             for (other, expected) in serial_images.items()
+                             if expected.shape == image.shape)
+            assert min(distances, key=distances.get) == name, name
+
+class TestPdfBundle(object):
+
+    def setup(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'surface.pdf')
+
+    def teardown(self):
+        shutil.rmtree(self.root)
+
+    def page_count(self):
+        with open(self.path, 'rb') as f:
+            return len(re.findall(br'/Type\s*/Page\b', f.read()))
+
+    def test_pages_and_index(self):
+        objs = fitted_objects(3)
+        bundle = plot.PdfBundle(self.path, title='surface')
+        bundle.INDEX_ENTRIES = 2
+        for obj in objs:
+            bundle.add(obj, plot.surface(obj))
+        assert bundle.num == 3
+        assert bundle.entries == [(i + 1, obj.format_chosen())
+                                  for (i, obj) in enumerate(objs)]
+        bundle.close()
+        # Three figures and two index pages of two entries each
+        assert self.page_count() == 5
+
+        text = bundle.index_figure(bundle.entries).texts[1].get_text()
+        for (page, chosen) in bundle.entries:
+            first = chosen.rstrip('\n').split('\n')[0]
+            assert '{:>5}  {}'.format(page, first) in text
+
+    def test_empty_bundle_has_index(self):
+        bundle = plot.PdfBundle(self.path, title='surface')
+        bundle.close()
+        assert bundle.num == 0
+        assert self.page_count() == 1
+
+def check_decimated(x, y, columns):
+    (dx, dy) = plot.decimate_line(x, y, columns)
+    assert len(dx) < len(x)
+    assert dx[0] == x[0] and dx[-1] == x[-1]
+    assert dy[0] == y[0] and dy[-1] == y[-1]
+    assert np.all(np.diff(dx) >= 0)
+    # Every kept point is a point of the line
+    kept = np.searchsorted(x, dx)
+    assert_array_equal(x[kept], dx)
+    column = np.minimum(
+        ((x - x[0]) * columns / (x[-1] - x[0])).astype(int), columns - 1)
+    kept_column = column[kept]
+    for c in np.unique(column):
+        (inside, kept_inside) = (column == c, kept_column == c)
+        assert dy[kept_inside].min() == y[inside].min()
+        assert dy[kept_inside].max() == y[inside].max()
+        assert dx[kept_inside][0] == x[inside][0]
+        assert dx[kept_inside][-1] == x[inside][-1]
+
+def test_decimate_line_keeps_column_extremes():
+    random = np.random.RandomState(2)
+    x = np.sort(random.uniform(3000, 7000, 5000))
+    for columns in (1, 7, 100):
+        yield check_decimated, x, random.normal(size=len(x)), columns
+    yield check_decimated, spectra.wavelength(), \
+        spectra.continuum(random, 1)[0], 50
+
+def test_decimate_line_unchanged():
+    x = np.linspace(0, 1, 40)
+    y = np.sin(x)
+    for (xs, columns) in ((x, 10), (x, 0), (x[::-1], 2), (np.zeros(40), 2)):
+        (dx, dy) = plot.decimate_line(xs, y, columns)
+        assert dx is xs and dy is y
+
+def test_line_columns():
+    fig = plot.new_figure(figsize=(2, 1))
+    assert plot.line_columns(fig) == 2 * plot.DECIMATE_DPI
+    assert plot.line_columns(fig, decimate=False) == 0
@@ -0,0 +1,84 @@
+import numpy as np
+from numpy.testing import assert_allclose
+
+from asad import pyasad
+import spectra
+
+#===============================================================================
+
+REDDENING = (0, 0.5, 0.01)
+CUT = (3800, 6000)
+
+def prepare(normalize, defer):
+    obsv = spectra.observation().reddening_shift(*REDDENING, defer=defer)
+    return normalize(obsv).wavelength_set_range(*CUT)
+
+def check_cut_after_normalization(normalize):
+    eager = prepare(normalize, defer=False)
+    deferred = prepare(normalize, defer=True)
+    assert deferred.is_deferred
+    assert_allclose(deferred.flux, eager.flux, rtol=1e-12)
+    rows = np.array([0, 7, 50])
+    assert_allclose(deferred.rows(rows), eager.flux[rows], rtol=1e-12)
+
+def test_deferred_average_normalization_before_cut():
+    check_cut_after_normalization(lambda obsv: obsv.normalize_average())
+
+def test_deferred_normalization_at_cut_wavelength():
+    # The normalization pixel is not part of the cut grid
+    check_cut_after_normalization(lambda obsv: obsv.normalize(3700))
+
+def test_deferred_normalization_inside_cut():
+    check_cut_after_normalization(lambda obsv: obsv.normalize(5000))
+
+def check_fused_matches_grid(normalize, defer, stat_test):
+    model = spectra.model().wavelength_set_range(*CUT).normalize_average()
+    stats = []
+    for (deferred, engine) in [(False, 'vectorized'), (defer, 'fused')]:
+        obsv = prepare(normalize, deferred)
+        obj = pyasad.Asad.from_observation_model(obsv, model)
+        obj.engine = engine
+        obj.stat_test = stat_test
+        stats.append(obj.calculate_stat())
+    assert_allclose(stats[1], stats[0], rtol=1e-10)
+
+def test_fused_engine_matches_eager_grid():
+    for normalize in (lambda obsv: obsv.normalize_average(),
+                      lambda obsv: obsv.normalize(5000)):
+        for defer in (True, False):
+            for stat_test in pyasad.Statistics.stat_tests().values():
+                yield check_fused_matches_grid, normalize, defer, stat_test
+
+def test_fused_engine_after_inplace_normalization():
+    obsv = spectra.observation().reddening_shift(*REDDENING)
+    obsv.normalize_average(inplace=True)
+    assert obsv.normalization_reference is not None
+    assert_allclose(obsv.reddened_flux(obsv.reddening), obsv.flux, rtol=1e-12)
+
+def check_continuous_matches_grid(defer):
+    model = spectra.model().wavelength_set_range(*CUT).normalize_average()
+    source = spectra.model().flux[5]
+    observation = lambda defer, reddening=REDDENING: spectra.observation(
+        source, reddening=-0.237).reddening_shift(
+            *reddening, defer=defer).normalize_average().wavelength_set_range(*CUT)
+
+    grid = pyasad.Asad.from_observation_model(observation(False), model)
+    grid.calculate_chosen_model()
+    continuous = pyasad.Asad.from_observation_model(observation(defer), model)
+    continuous.search = 'continuous'
+    continuous.calculate_chosen_model()
+
+    assert continuous.min_model == grid.min_model == 5
+    reddening = continuous.model_reddening[continuous.min_model]
+    assert abs(reddening - grid.min_reddening) <= REDDENING[2]
+    assert continuous.min_stat <= grid.min_stat
+
+    # The continuous statistic is the eager one at the reddening it found
+    eager = pyasad.Asad.from_observation_model(
+        observation(False, (reddening, reddening, 1)), model)
+    eager.calculate_stat()
+    assert_allclose(continuous.min_stat, eager.stat[0, 5], rtol=1e-9)
+
+def test_continuous_reddening_matches_grid_after_cut():
+    for defer in (True, False):
+        yield check_continuous_matches_grid, defer
@@ -0,0 +1,125 @@
+import numpy as np
+from numpy.testing import assert_allclose
+
+from asad import pyasad
+import spectra
+
+Statistics = pyasad.Statistics
+
+#===============================================================================
+
+def close_fit(dtype):
+    "Observations almost equal to some of the models, where chi-squared cancels most"
+    rng = np.random.RandomState(0)
+    models = 1 + 0.3 * rng.rand(40, 800)
+    observations = models[[3, 17, 30]] + 1e-3 * rng.randn(3, 800)
+    return (observations.astype(dtype), models.astype(dtype))
+
+def test_single_precision_chi_squared_matches_double():
+    (xss, yss) = close_fit(np.float32)
+    # Double precision reference on the same, already rounded, values
+    expected = Statistics.loop_matrix(Statistics.chi_squared_freq_test,
+                                      xss.astype(np.float64),
+                                      yss.astype(np.float64))
+    stat = Statistics.chi_squared_matrix(xss, yss)
+    assert stat.dtype == np.float64
+    assert_allclose(stat, expected, rtol=1e-6)
+
+def check_tiled_matches_untiled(stat_test, dtype, max_memory_mb):
+    (xss, yss) = close_fit(dtype)
+    (stat, tile) = Statistics.tiled_matrix(stat_test, xss, yss, max_memory_mb)
+    assert tile != (xss.shape[0], yss.shape[0])
+    expected = Statistics.matrix_test(stat_test)(xss, yss)
+    # Tiles sum the product in another order, cancellation magnifies it
+    assert_allclose(stat, expected, rtol=1e-6 if dtype == np.float32 else 1e-9)
+
+def test_tiled_matches_untiled():
+    budgets = {
+        Statistics.chi_squared_freq_test : (0.05, 0.1),
+        # Down to single cells, then several models per tile
+        Statistics.ks_2_sample_freq_test : (0.05, 0.5),
+    }
+    for (stat_test, memory) in budgets.items():
+        for max_memory_mb in memory:
+            for dtype in (np.float64, np.float32):
+                yield (check_tiled_matches_untiled,
+                       stat_test, dtype, max_memory_mb)
+
+def test_tile_size_fits_budget():
+    for stat_test in Statistics.stat_tests().values():
+        for max_memory_mb in (0.05, 0.5, 4):
+            (tile_x, tile_y) = Statistics.tile_size(
+                stat_test, 3, 40, 800, max_memory_mb)
+            used = Statistics.operand_bytes(stat_test, 40, 800) + \
+                Statistics.tile_bytes(stat_test, tile_x, tile_y, 800)
+            assert used <= max_memory_mb * 2**20 or (tile_x, tile_y) == (1, 1)
+
+def test_ks_matrix_matches_loop():
+    (xss, yss) = close_fit(np.float64)
+    expected = Statistics.loop_matrix(Statistics.ks_2_sample_freq_test, xss, yss)
+    # One chunk, a chunk per row and a chunk size not dividing the rows
+    for chunk_size in (None, 1, 2):
+        assert_allclose(Statistics.ks_2_sample_matrix(xss, yss, chunk_size),
+                        expected, rtol=1e-12)
+
+def test_vectorized_chi_squared_matches_loop():
+    for dtype in (np.float64, np.float32):
+        (xss, yss) = close_fit(dtype)
+        expected = Statistics.loop_matrix(
+            Statistics.chi_squared_freq_test, xss, yss)
+        assert_allclose(Statistics.chi_squared_matrix(xss, yss), expected,
+                        rtol=1e-6 if dtype == np.float32 else 1e-9)
+
+def test_vectorized_engine_matches_loop_engine():
+    model = spectra.model()
+    obsv = spectra.observation(model.flux[4], reddening=-0.1)
+    stats = {}
+    for engine in ('vectorized', 'loop'):
+        obj = pyasad.Asad.from_observation_model(
+            obsv.reddening_shift(0, 0.3, 0.01), model)
+        obj.engine = engine
+        obj.calculate_chosen_model()
+        stats[engine] = obj
+    # The exact fit is 0 in the loop, a rounding error in the product
+    assert_allclose(stats['vectorized'].stat, stats['loop'].stat,
+                    rtol=1e-9, atol=1e-9)
+    assert stats['vectorized'].min_model == stats['loop'].min_model == 4
+    assert stats['vectorized'].min_observation == stats['loop'].min_observation
+
+def coarse_fit(source=37, reddening=-0.42):
+    "A reddening x age grid large enough for several refinement levels"
+    model = spectra.model(num=80)
+    obsv = spectra.observation(model.flux[source], reddening=reddening)
+    return pyasad.Asad.from_observation_model(
+        obsv.reddening_shift(0, 1.0, 0.01), model)
+
+def test_coarse_search_finds_grid_optimum():
+    grid = coarse_fit()
+    grid.calculate_chosen_model()
+    obj = coarse_fit()
+    obj.search = 'coarse'
+    obj.calculate_chosen_model()
+    assert (obj.min_observation, obj.min_model) == \
+        (grid.min_observation, grid.min_model)
+    assert 0 < obj.evaluated_cells < grid.stat.size
+
+def test_coarse_search_evaluates_each_cell_once():
+    calls = []
+    def counted(x, y):
+        calls.append(1)
+        return Statistics.chi_squared_freq_test(x, y)
+    obj = coarse_fit()
+    obj.search = 'coarse'
+    obj.stat_test = counted
+    obj.calculate_chosen_model()
+    assert len(calls) == obj.evaluated_cells == np.sum(np.isfinite(obj.stat))
+
+def test_coarse_search_with_every_candidate_is_exhaustive():
+    grid = coarse_fit()
+    grid.calculate_stat()
+    obj = coarse_fit()
+    obj.search = 'coarse'
+    obj.coarse_candidates = grid.stat.size
+    obj.calculate_chosen_model()
+    assert obj.evaluated_cells == grid.stat.size
+    assert_allclose(obj.stat, grid.stat, rtol=1e-12)
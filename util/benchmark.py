@@ -0,0 +1,123 @@
+"""Fit observations against a model in every precision and compare.
+
+Prints the fit time and operand memory of each precision, and how far the
+chosen age, reddening and statistic of every observation move from the
+double precision fit.
+
+    python util/benchmark.py data/observations data/models/model.txt
+"""
+from __future__ import print_function
+
+import argparse
+import glob
+import os, os.path
+import time
+
+import numpy as np
+from asad import pyasad
+
+#===============================================================================
+
+def parse():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('observations', help='Observation file or directory')
+    parser.add_argument('model', help='Model file')
+    parser.add_argument('--format', default='DELGADO',
+                        choices=pyasad.Model.MODEL_FORMATS)
+    parser.add_argument('--wavelength', type=float, nargs=2,
+                        default=[3650, 6200], metavar=('Start', 'End'))
+    parser.add_argument('--age', type=float, nargs=2, default=[6.6, 0.05],
+                        metavar=('Start', 'Step'))
+    parser.add_argument('--normalize', type=float, default=5870,
+                        metavar='Wavelength')
+    parser.add_argument('--reddening', type=float, nargs=3,
+                        default=[0, 0.5, 0.01], metavar=('Start', 'End', 'Step'))
+    parser.add_argument('--stat', default=pyasad.Statistics.STAT_TEST_NAMES[0],
+                        choices=pyasad.Statistics.STAT_TEST_NAMES)
+    parser.add_argument('--engine', default=pyasad.Asad.STAT_ENGINES[0],
+                        choices=pyasad.Asad.STAT_ENGINES)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Fits per precision, the fastest is reported')
+    return parser.parse_args()
+
+def observation_paths(path):
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, f) for f in os.listdir(path)
+                      if os.path.isfile(os.path.join(path, f)))
+    return sorted(glob.glob(path))
+
+def prepare(args):
+    (start, end) = args.wavelength
+    model = pyasad.Model(path=args.model, format=args.format)
+    # As model set_age_start / set_age_step do
+    (model.age_start, model.age_step) = args.age
+    model.age = None
+    model = model.wavelength_set_range(start, end).normalize(args.normalize)
+    observations = []
+    for path in observation_paths(args.observations):
+        obsv = pyasad.Observation(path=path)
+        obsv = obsv.wavelength_set_range(start, end)
+        obsv = obsv.reddening_shift(*args.reddening)
+        observations.append(obsv.normalize(args.normalize))
+    return (observations, model)
+
+def fit(args, observations, model, precision):
+    "(objects, fastest fit time, operand bytes) of one precision"
+    dtype = pyasad.Asad.precision_dtype(precision)
+    model = model.astype(dtype)
+    observations = [obsv.astype(dtype) for obsv in observations]
+    objs = []
+    for obsv in observations:
+        obj = pyasad.Asad.from_observation_model(obsv, model)
+        obj.stat_test = pyasad.Statistics.stat_tests()[args.stat]
+        obj.engine = args.engine
+        objs.append(obj)
+
+    best = None
+    for i in range(max(1, args.repeat)):
+        start = time.time()
+        for obj in objs:
+            obj.calculate_chosen_model()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    nbytes = model.flux.nbytes + sum(o.flux.nbytes for o in observations)
+    return (objs, best, nbytes)
+
+def report(results):
+    (reference, ref_time, ref_bytes) = results['double']
+    for (precision, (objs, elapsed, nbytes)) in sorted(results.items()):
+        print('{:<8} {:>10.4f} s {:>10.2f} MB  x{:.2f} time  x{:.2f} memory'.format(
+            precision, elapsed, nbytes / 2.0**20,
+            elapsed / ref_time, float(nbytes) / ref_bytes))
+
+    for (precision, (objs, elapsed, nbytes)) in sorted(results.items()):
+        if precision == 'double':
+            continue
+        print('\nDrift of {} from double precision'.format(precision))
+        print('{:<40} {:>10} {:>10} {:>12}'.format(
+            'Observation', 'Age', 'Reddening', 'Stat (rel)'))
+        drift = []
+        for (ref, obj) in zip(reference, objs):
+            d = (abs(obj.min_age - ref.min_age),
+                 abs(obj.min_reddening - ref.min_reddening),
+                 abs(obj.min_stat - ref.min_stat) / max(abs(ref.min_stat), 1e-300))
+            drift.append(d)
+            print('{:<40} {:>10.4f} {:>10.4f} {:>12.3e}'.format(
+                ref.observation.name, *d))
+        drift = np.array(drift)
+        moved = np.sum((drift[:, 0] > 0) | (drift[:, 1] > 0))
+        print('{} of {} chosen (age, reddening) moved, max age {:.4f}, '
+              'max reddening {:.4f}, max relative stat {:.3e}'.format(
+                  moved, len(drift), *drift.max(axis=0)))
+
+def main():
+    args = parse()
+    (observations, model) = prepare(args)
+    results = dict((precision, fit(args, observations, model, precision))
+                   for precision in pyasad.Asad.PRECISIONS)
+    report(results)
+
+#===============================================================================
+
+if __name__ == '__main__':
+    main()